@@ -10,7 +10,15 @@ from PYME.IO import MetaDataHandler
 
 from PYME.contrib import dispatch
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger(__name__)
+
 class ImageFrameSource(object):
+    __slots__ = ('onFrame', 'spoolProgress', '__weakref__')
+    
     def __init__(self):
         #self.image = image
         
@@ -23,7 +31,7 @@ class ImageFrameSource(object):
         
         self.spoolData(image.ImageStack(filename).data)
         
-    def spoolData(self, data):
+    def spoolData(self, data, prefetch=8):
         """Extract frames from a data source.
         
         Parameters
@@ -32,18 +40,48 @@ class ImageFrameSource(object):
         data : PYME.IO.DataSources.DataSource object
             the data source. Needs to implement the getNumSlices() and getSlice()
             methods.
+        prefetch : int
+            the number of frames to read ahead (in a background thread) while
+            the current frame is being sent, so that reading from disk overlaps
+            with compression / upload. Frames are read one at a time (and in
+            order) as not all data sources are thread safe. Set to 0 to read
+            frames synchronously.
         """
         nFrames = data.getNumSlices()
-        for i in range(nFrames):
-            self.onFrame.send(self, frameData=data.getSlice(i))
-            if (i % 3000) == 0:
-                self.spoolProgress.send(self, percent=float(i)/nFrames)
-                print('Spooling %d of %d frames' % (i, nFrames))
+        
+        # look up the receivers once, rather than on every send. The spooler
+        # connects before we start and disconnects after we finish.
+        receivers = self.onFrame._live_receivers(self)
+        
+        if prefetch < 1:
+            for i in range(nFrames):
+                self._sendFrame(receivers, data.getSlice(i), i, nFrames)
+            return
+        
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            pending = collections.deque(reader.submit(data.getSlice, i) for i in range(min(prefetch, nFrames)))
+            for i in range(nFrames):
+                frameData = pending.popleft().result()
+                if (i + prefetch) < nFrames:
+                    pending.append(reader.submit(data.getSlice, i + prefetch))
+                
+                self._sendFrame(receivers, frameData, i, nFrames)
+    
+    def _sendFrame(self, receivers, frameData, i, nFrames):
+        """Equivalent to self.onFrame.send(), but with pre-resolved receivers"""
+        for receiver in receivers:
+            receiver(signal=self.onFrame, sender=self, frameData=frameData)
+            
+        if (i % 3000) == 0:
+            self.spoolProgress.send(self, percent=float(i)/nFrames)
+            logger.debug('Spooling %d of %d frames' % (i, nFrames))
             
           
 
 class MDSource(object):
     """Spoof a metadata source for the spooler"""
+    __slots__ = ('mdh', '__weakref__')
+    
     def __init__(self, mdh):
         self.mdh = mdh
 
@@ -111,12 +149,25 @@ def _getFilenameSuggestion(dirname='', seriesname = SERIES_PATTERN):
 
     seriesCounter = 0
     seriesName = seriesStub % {'counter' : nameUtils.numToAlpha(seriesCounter)}
+    
+    try:
+        # list the directory once, rather than asking the cluster about each candidate name in turn
+        existing = set(clusterIO.listdir(dirname))
+        
+        def exists(name):
+            leaf = name.split('/')[-1]
+            return (leaf in existing) or ((leaf + '/') in existing)
+    except Exception:
+        logger.exception('Could not list %s, falling back to checking names individually' % dirname)
+        
+        def exists(name):
+            return clusterIO.exists(name + '/')
         
     #try to find the next available serie name
-    while clusterIO.exists(seriesName + '/'):
+    while exists(seriesName):
         seriesCounter +=1
         
-        if '%(counter)' in seriesName:
+        if '%(counter)' in seriesStub:
             seriesName = seriesStub % {'counter' : nameUtils.numToAlpha(seriesCounter)}
         else:
             seriesName = seriesStub + '_' + nameUtils.numToAlpha(seriesCounter)
@@ -6,6 +6,7 @@ import logging
 
 logger = logging.getLogger(__name__)
 QUEUE_MAX_SIZE = 200 # ~10k frames
+SMALL_PUT_SIZE = 65536 # chunks up to this size (in bytes) are sent in the same write as their header
 
 class Stream(object):
     """
@@ -105,8 +106,13 @@ class Stream(object):
                 
                 logger.debug(header)
                 
-                self._socket.sendall(header)
-                if dl > 0:
+                if dl <= SMALL_PUT_SIZE:
+                    # send header and data together so that (with TCP_NODELAY) small chunks go out as a single
+                    # packet rather than a header-only packet followed by the data
+                    self._socket.sendall(b''.join((header, data)))
+                else:
+                    # don't copy large chunks just to prepend the header
+                    self._socket.sendall(header)
                     self._socket.sendall(data)
                     
                 self._put_queue.task_done()
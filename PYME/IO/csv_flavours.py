@@ -1,15 +1,19 @@
+import os
+import re
+import codecs
+import functools
 import numpy as np
 from PYME.IO import MetaDataHandler
 
 import logging
 logger = logging.getLogger(__file__)
 
+# matches the strings float() accepts (bar digit-grouping underscores). Matching a regex is much cheaper than raising
+# and catching a ValueError for every non-numeric field, which is the common case when sniffing headers.
+_number_re = re.compile(r'\s*[-+]?(?:(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?|nan|inf(?:inity)?)\s*', re.IGNORECASE)
+
 def isnumber(s):
-    try:
-        float(s)
-        return True
-    except:
-        return False
+    return _number_re.fullmatch(s) is not None
 
 
 csv_flavours = {
@@ -64,87 +68,194 @@ csv_flavours = {
     },
 }
 
+# how much of a file to read when looking for the header
+HEADER_SNIFF_BYTES = 65536
+
 requiredNames = {'x':'x position [nm]',
                     'y':'y position [nm]'}
 
 
 def parse_csv_header(filename):
+    """
+    Sniff the header of a delimited text file.
+    
+    Returns
+    -------
+    colNames : list of str
+    dataLines : list of list of str
+        the first few data lines, split on the delimiter
+    nHeaderLines : int
+        the number of comment/header lines preceding the data
+    delim : str
+        the guessed delimiter
+    
+    Notes
+    -----
+    Results are cached on (filename, modification time, size), so that repeatedly opening the same file (e.g. preview
+    in the import dialog and then the actual load) only parses the header once.
+    """
+    colNames, dataLines, nHeaderLines, delim, _ = _sniff_csv_header(filename)
+    
+    # return copies so that callers can't modify the cached values
+    return list(colNames), [list(l) for l in dataLines], nHeaderLines, delim
+
+def _sniff_csv_header(filename):
+    """ As `parse_csv_header()`, but also returns the byte offset of the first data line (uncopied, do not modify)"""
+    st = os.stat(filename)
+    return _parse_csv_header_cached(filename, st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=128)
+def _parse_csv_header_cached(filename, mtime, size):
+    # mtime and size are not used directly, but serve as cache keys
     n = 0
     commentLines = []
     dataLines = []
     headerNameLines = []
 
     def is_header_candidate(line, delims):
+        # also return the guessed delimiter so that we don't need to guess it again for the header line
         guessedDelim = guess_delim(line,delims)
         if guessedDelim is not None:
-            return not isnumber(line.split(guessedDelim)[0])
+            return (not isnumber(line.partition(guessedDelim)[0])), guessedDelim
         else:
-            return False
+            return False, guessedDelim
 
     def guess_delim(line,delims):
-        maxItems = 1
+        maxCount = 0
         guessedDelim = None
         
         for delim in delims:
-            # simple heuristic that the proper delimiter will produce more items when used for split
-            if len(line.split(delim)) > maxItems:
-                maxItems = len(line.split(delim))
+            # simple heuristic that the proper delimiter will occur most often
+            # (count rather than split to avoid building lists of substrings)
+            count = line.count(delim)
+            if count > maxCount:
+                maxCount = count
                 guessedDelim = delim
 
         return guessedDelim
     
-    fid = open(filename, 'r')
+    # read the head of the file in one go rather than line by line
+    with open(filename, 'rb') as fid:
+        head = fid.read(HEADER_SNIFF_BYTES)
+    
+    if len(head) == HEADER_SNIFF_BYTES:
+        # discard the (potentially truncated) last line
+        head = head[:(head.rfind(b'\n') + 1)]
+    
+    # byte offset of the current line in the file
+    offset = 0
+    if head.startswith(codecs.BOM_UTF8):
+        # some files come with a byte order mark prepended
+        head = head[len(codecs.BOM_UTF8):]
+        offset = len(codecs.BOM_UTF8)
+    
+    encoding = 'utf-8'
+    try:
+        head = head.decode(encoding)
+    except UnicodeDecodeError:
+        # Zeiss Elyra files are latin-1
+        encoding = 'latin-1'
+        head = head.decode(encoding)
 
     # NB - we could previously read whitespace-delimited data where the whitespace was not a tab
     # This is probably safer, but could result in regressions. 
     delims = [',','\t']
     delim = None # default
+    data_offset = None
 
-    while n < 10: # only look at first 10 data lines max
-        line = fid.readline()
+    # split on '\n' only - str.splitlines() also breaks on e.g. '\x0c' and '\x85', which would throw our line counts and
+    # byte offsets out of step with the parsers
+    raw_lines = [l + '\n' for l in head.split('\n')]
+    raw_lines[-1] = raw_lines[-1][:-1] # last piece has no line ending
+    if raw_lines[-1] == '':
+        raw_lines.pop()
+    
+    for raw_line in raw_lines:
+        if n >= 10: # only look at first 10 data lines max
+            break
+        
+        line = raw_line.rstrip('\r\n')
+        if n == 0:
+            # remember where this line starts, in case it is the first data line. We only need the byte length of
+            # lines before the first data line, so only pay for the encode until we get there.
+            line_start = offset
+            offset += len(raw_line.encode(encoding))
+        
         if line.startswith('#'): #check for comments
             commentLines.append(line[1:])
-        elif is_header_candidate(line, delims): # textual header that is not a comment
-            # we later assume that the last comment line contains the column headers
-            # this is required, as the default .csv format uses a commented header for the column names.
-            commentLines.append(line)
-            delim = guess_delim(line,delims)
+        elif delim is not None:
+            # we already know the delimiter, so skip the delimiter guessing in is_header_candidate() and just check
+            # whether the first field is numeric
+            first, sep, _ = line.partition(delim)
+            if sep and not isnumber(first):
+                commentLines.append(line)
+            else:
+                dataLines.append(line.split(delim))
+                n += 1
         else:
-            # upon first encounter we may need to check if ','-delimited or '\t'-delimited!
-            if delim is None:
-                delim = guess_delim(line,delims)
-            dataLines.append(line.split(delim))
-            n += 1
+            # upon first encounter we need to check if ','-delimited or '\t'-delimited!
+            is_header, delim = is_header_candidate(line, delims)
+            if is_header: # textual header that is not a comment
+                # we later assume that the last comment line contains the column headers
+                # this is required, as the default .csv format uses a commented header for the column names.
+                commentLines.append(line)
+            else:
+                dataLines.append(line.split(delim))
+                n += 1
+        
+        if (n == 1) and (data_offset is None):
+            data_offset = line_start
+    
+    if len(dataLines) == 0:
+        raise RuntimeError('No data found in the first %d bytes of %s' % (HEADER_SNIFF_BYTES, filename))
             
     numCols = len(dataLines[0])
     
     if len(commentLines) > 0 and len(commentLines[-1].split(delim)) == numCols:
         colNamesRaw = [s.strip() for s in commentLines[-1].split(delim)]
         # the stuff below seemed necessary since (1) some names came with byte order mark, or BOM, prepended
-        # and (2) some had quotes around the names
-        colNames = [name.encode('utf-8').decode('utf-8-sig').strip('"').replace('-', '').rstrip() for name in colNamesRaw]
+        # and (2) some had quotes around the names. A BOM at the start of the file is already stripped when reading,
+        # but strip it here too (without a utf-8 encode/decode round trip per name) in case one hides behind a comment.
+        colNames = [name.lstrip(u'\ufeff').strip('"').replace('-', '').rstrip() for name in colNamesRaw]
     else:
         colNames = ['column_%d' % i for i in range(numCols)]
 
-    return colNames, dataLines, len(commentLines), delim
+    return colNames, dataLines, len(commentLines), delim, data_offset
 
 
-def replace_names(old_names, flavour):
-    newnames = []
+# in names we replace spaces with underscores
+_space_to_underscore = str.maketrans(' ', '_')
 
-    repdict = csv_flavours[flavour]['column_name_mappings']
+# column name mappings with the space replacement pre-applied to the new names, populated on first use
+_flavour_mappings = {}
 
-    for name in old_names:
-        if name in repdict.keys():
-            newname = repdict[name]
-        else:
-            newname = name
-        newnames.append(newname.replace(' ','_')) # in names we replace spaces with underscores
+def replace_names(old_names, flavour):
+    try:
+        repdict = _flavour_mappings[flavour]
+    except KeyError:
+        repdict = {k: v.translate(_space_to_underscore) for k, v in csv_flavours[flavour]['column_name_mappings'].items()}
+        _flavour_mappings[flavour] = repdict
     
-    return newnames
+    return [repdict.get(name, None) or name.translate(_space_to_underscore) for name in old_names]
 
-def guess_text_options(filename):
-    colNames, _, n_skip, delim = parse_csv_header(filename)
+def guess_text_options(filename, usecols=None):
+    """
+    Guess the options needed to load a delimited text file with `PYME.IO.tabular.TextfileSource`.
+    
+    Parameters
+    ----------
+    filename : str
+    usecols : collection of str, optional
+        Only load these columns (names after flavour translation, e.g. 'x', 'y', 't'). Files exported from other
+        software often have many columns we don't use, and skipping them substantially speeds up parsing. Columns in
+        `requiredNames` are always loaded. The default is to load all columns.
+
+    Returns
+    -------
+    text_options : dict
+        keyword arguments for `TextfileSource`
+    """
+    colNames, _, n_skip, delim, data_offset = _sniff_csv_header(filename)
     flavour = guess_flavour(colNames, delim)
 
     logger.info('Guessed text file flavour: %s' % flavour)
@@ -153,8 +264,12 @@ def guess_text_options(filename):
     text_options = {'columnnames': colNames,
                     'skiprows' : n_skip,
                     'delimiter' : delim,
-                    'invalid_raise' : not csv_flavours[flavour].get('ignore_errors', False)
+                    'invalid_raise' : not csv_flavours[flavour].get('ignore_errors', False),
+                    'data_offset' : data_offset, # lets the parsers seek straight past the header
                     }
+    
+    if usecols is not None:
+        text_options['usecols'] = [n for n in colNames if (n in usecols) or (n in requiredNames)]
 
     return text_options
 
@@ -168,11 +283,23 @@ def check_required_names(self):
 
         
 
+# frozensets of the identifying column names for each flavour, populated on first use (see `_idnames_set()`)
+_flavour_idnames = {}
+
+def _idnames_set(flavour):
+    try:
+        return _flavour_idnames[flavour]
+    except KeyError:
+        idnames = frozenset(csv_flavours[flavour]['idnames'])
+        _flavour_idnames[flavour] = idnames
+        return idnames
+
 def guess_flavour(colNames, delim=None):
     # guess csv flavour by matching column names
     fl = None
+    colSet = frozenset(colNames)
     for flavour in csv_flavours:
-        if (not flavour == 'default') and all(idn in colNames for idn in csv_flavours[flavour]['idnames']):
+        if (not flavour == 'default') and (_idnames_set(flavour) <= colSet):
             if not fl is None:
                 raise RuntimeError('Ambiguous flavour database: file matches both %s and %s' % (fl, flavour))
             fl = flavour
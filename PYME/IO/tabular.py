@@ -29,6 +29,9 @@ understand additional values, e.g. 'error_x'
 import types
 import six
 import warnings
+import os
+import json
+import contextlib
 import numpy as np
 
 from numpy import * #to allow the use of sin cos etc in mappings
@@ -560,60 +563,325 @@ class HDFSource(H5RSource):
 #
 #     def getInfo(self):
 #         return 'PYME h5r Drift Data Source\n\n %d points' % self.h5f.root.DriftResults.shape[0]
+def _drop_missing_values(columns):
+    """
+    Discard rows which have a missing (NaN) value in any column of a dict of columns.
+    
+    Returns
+    -------
+    columns : dict
+        the filtered columns
+    n_dropped : int
+        the number of rows discarded
+    """
+    # OR together the NaN masks of each (contiguous) column so that every column gets checked
+    bad = np.zeros(len(next(iter(columns.values()))), bool)
+    for v in columns.values():
+        bad |= np.isnan(v)
+    
+    n_dropped = int(np.count_nonzero(bad))
+    if n_dropped > 0:
+        good = ~bad
+        columns = {k: v[good] for k, v in columns.items()}
+    
+    return columns, n_dropped
+
 @deprecated_name('textfileSource')
 class TextfileSource(TabularBase):
     _name = "Text File Source"
-    def __init__(self, filename, columnnames, delimiter=None, skiprows=0, skip_footer=0, invalid_raise=True, comments='#'):
+    def __init__(self, filename, columnnames, delimiter=None, skiprows=0, skip_footer=0, invalid_raise=True, comments='#',
+                 usecols=None, data_offset=None):
         """ Input filter for use with delimited text data. Defaults
         to whitespace delimiter. Need to provide a list of variable names
         in the order that they appear in the file. Using 'x', 'y' and 'error_x'
         for the position data and it's error should ensure that this functions
-        with the visualisation backends"""
+        with the visualisation backends.
+        
+        If `usecols` (a collection of column names) is given, only those columns are parsed, which can be substantially
+        faster for files with many columns.
+        
+        If `data_offset` (the byte offset of the first data line, as found by `csv_flavours.guess_text_options()`) is
+        given, parsing starts there and `skiprows` is ignored, so the parsers don't need to re-tokenise the header."""
 
         #self.res = np.loadtxt(filename, dtype={'names' : columnnames,  # TODO: evaluate why these are cast as floats
         #                                       'formats' :  ['f4' for i in range(len(columnnames))]}, delimiter = delimiter, skiprows=skiprows)
 
         from PYME import config
+
+        self.filename = filename
+        self._data_offset = data_offset
+        if data_offset is not None:
+            skiprows = 0
+        
+        self.res = None
+        use_cache = config.get('TextFileSource-cache_parquet', False)
+        if use_cache:
+            cache_key = json.dumps([list(columnnames), delimiter, skiprows, skip_footer, invalid_raise, comments,
+                                    None if usecols is None else sorted(usecols), data_offset])
+            self.res = self._read_parquet_cache(cache_key)
         
-        #print('invalid_raise:', invalid_raise)
-
-        if config.get('TextFileSource-use_pandas',False):
-            print('Opening %s using pandas (set TextFileSource-use_pandas: False in config.yaml to use legacy np.genfromtxt instead)')
-            import pandas as pd
-            self.res = pd.read_csv(filename,
-                comment=comments,
-                delimiter=delimiter,
-                skiprows=skiprows,
-                skipfooter=skip_footer,
-                names=columnnames,
-                dtype='f4',
-                skipinitialspace=True,
-                on_bad_lines='error' if invalid_raise else 'warn,'
-                ).to_records(index=False)
+        if self.res is None:
+            self.res = self._parse(columnnames, delimiter, skiprows, skip_footer, invalid_raise, comments, usecols)
+            
+            if use_cache:
+                self._write_parquet_cache(cache_key)
 
-        else:
-            print('Opening %s using np.genfromtxt (set TextFileSource-use_pandas: True in config.yaml to use pandas instead)')
-            self.res = np.genfromtxt(filename,
-                             comments=comments,
-                             delimiter=delimiter,
-                             skip_header=skiprows,
-                             skip_footer=skip_footer,
-                             names=columnnames, 
-                             dtype='f4', replace_space='_',
-                             missing_values=None, filling_values=np.nan, # use NaN to flag missing values
-                             invalid_raise=invalid_raise,
-                             encoding='latin-1') # Zeiss Elyra bombs unless we go for latin-1 encoding, maybe make flavour specific?
-
-        # check for missing values:
+        self._keys = list(self.res.keys())
+       
+
+    def _parse(self, columnnames, delimiter, skiprows, skip_footer, invalid_raise, comments, usecols=None):
+        """ Parse the text file, trying the fastest available parser first"""
+        from PYME import config
+        
+        if usecols is not None:
+            # normalise to a list of names in file order
+            usecols = [n for n in columnnames if n in usecols]
+        
+        res = None
+        if config.get('TextFileSource-use_pyarrow', True) and (delimiter is not None) and (skip_footer == 0):
+            # optional, multi-threaded fast path. Falls through to pandas if pyarrow is not installed or chokes on the
+            # file (e.g. comment lines interspersed with the data, which pyarrow cannot skip)
+            try:
+                res = self._read_pyarrow(columnnames, delimiter, skiprows, invalid_raise, usecols)
+                logger.info('Opened %s using pyarrow' % self.filename)
+            except ImportError:
+                pass
+            except ValueError as e:
+                logger.info('Could not parse %s with pyarrow (%s), trying pandas' % (self.filename, e))
+        
+        if (res is None) and config.get('TextFileSource-use_pandas', True):
+            logger.info('Opening %s using pandas (set TextFileSource-use_pandas: False in config.yaml to use legacy np.genfromtxt instead)' % self.filename)
+            try:
+                res = self._read_pandas(columnnames, delimiter, skiprows, skip_footer, invalid_raise, comments, usecols)
+            except ImportError:
+                logger.info('pandas not available, falling back to np.genfromtxt')
+            except ValueError as e:
+                if invalid_raise:
+                    logger.exception('Error parsing %s with pandas, falling back to np.genfromtxt' % self.filename)
+                else:
+                    # expected for formats flagged with 'ignore_errors' (e.g. Zeiss Elyra), which contain lines the
+                    # pandas tokenizer won't accept but np.genfromtxt can skip
+                    logger.info('Could not parse %s with pandas (%s), falling back to np.genfromtxt' % (self.filename, e))
+        
+        if (res is None) and (skip_footer == 0) and (np.lib.NumpyVersion(np.__version__) >= '1.23.0'):
+            # numpy >= 1.23 has a C implementation of loadtxt which is much faster than np.genfromtxt. It can't cope with
+            # missing values or malformed lines, however, so fall back to np.genfromtxt if it fails.
+            try:
+                res = self._read_loadtxt(columnnames, delimiter, skiprows, comments, usecols)
+                logger.info('Opened %s using np.loadtxt' % self.filename)
+            except ValueError:
+                pass
+        
+        if res is None:
+            logger.info('Opening %s using np.genfromtxt (set TextFileSource-use_pandas: True in config.yaml to use pandas instead)' % self.filename)
+            res = self._read_genfromtxt(columnnames, delimiter, skiprows, skip_footer, invalid_raise, comments, usecols)
+
+        if not isinstance(res, dict):
+            # np.loadtxt and np.genfromtxt give us a record array, convert to contiguous columns
+            res = {n: np.ascontiguousarray(res[n]) for n in res.dtype.names}
+
+        # check for missing values (NB - the pandas reader already does this chunk by chunk):
         # TODO - is this needed/helpful, or should we propagate missing values further?
-        # cast to a non-structured dtype and use the fact than the sum will be NaN if any of the individual values is NaN
-        r = self.res.view(('f4', len(columnnames))).sum(1)
-        if np.any(np.isnan(r)):
+        res, n_dropped = _drop_missing_values(res)
+        if n_dropped > 0:
             logger.warning('Text file contains missing values, discarding lines with missing values')
-            self.res = self.res[~np.isnan(r)]
 
-        self._keys = list(columnnames)
-       
+        return res
+
+    @contextlib.contextmanager
+    def _data_source(self):
+        """ Yield the source to hand to the parsers - the filename, or, if we know where the data starts, a binary file
+        object positioned at the first data line"""
+        if self._data_offset is None:
+            yield self.filename
+        else:
+            with open(self.filename, 'rb') as f:
+                f.seek(self._data_offset)
+                yield f
+    
+    @property
+    def _parquet_cache_filename(self):
+        return self.filename + '.cache.parquet'
+    
+    def _read_parquet_cache(self, cache_key):
+        """ Load previously parsed data from a parquet file next to the text file. Returns None if there is no valid cache
+        (missing, older than the text file, or written with different parsing options)."""
+        cache_filename = self._parquet_cache_filename
+        try:
+            if os.path.getmtime(cache_filename) < os.path.getmtime(self.filename):
+                return None
+            
+            import pyarrow.parquet as pq
+        except (OSError, ImportError):
+            return None
+        
+        try:
+            table = pq.read_table(cache_filename)
+            
+            metadata = table.schema.metadata or {}
+            if metadata.get(b'PYME.TextfileSource.options', b'').decode() != cache_key:
+                return None
+            
+            res = {n: table.column(n).to_numpy() for n in table.column_names}
+        except Exception as e:
+            # cache is optional - if it is truncated or corrupt, re-parse the text file (which also rewrites the cache)
+            logger.warning('Could not read parquet cache %s (%s), re-parsing %s' % (cache_filename, e, self.filename))
+            return None
+        
+        logger.info('Loaded %s from cache (%s)' % (self.filename, cache_filename))
+        return res
+    
+    def _write_parquet_cache(self, cache_key):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            logger.debug('pyarrow not available, not writing parquet cache for %s' % self.filename)
+            return
+        
+        try:
+            table = pa.Table.from_arrays([pa.array(v) for v in self.res.values()], names=list(self.res.keys()))
+            table = table.replace_schema_metadata({'PYME.TextfileSource.options': cache_key})
+            pq.write_table(table, self._parquet_cache_filename, compression='zstd')
+        except Exception:
+            # cache is a nice to have - e.g. the text file might live in a read-only directory
+            logger.exception('Could not write parquet cache for %s' % self.filename)
+    
+    def _sniff_encoding(self, n_bytes=4096):
+        """ Zeiss Elyra files need to be decoded as latin-1, but this forces the parsers off their (much faster) utf-8
+        paths. Most files are pure ASCII, so check the start of the file and only use latin-1 if we find non-ASCII
+        characters."""
+        with open(self.filename, 'rb') as f:
+            sample = f.read(n_bytes)
+        
+        return 'utf-8' if sample.isascii() else 'latin-1'
+    
+    def _read_pyarrow(self, columnnames, delimiter, skiprows, invalid_raise, usecols=None):
+        """ Parse using pyarrow's multi-threaded CSV reader. Raises ImportError if pyarrow is not available."""
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+        
+        # read in large (8 MB) blocks, which are tokenised in parallel
+        read_options = pacsv.ReadOptions(skip_rows=skiprows, column_names=columnnames, encoding=self._sniff_encoding(),
+                                         use_threads=True, block_size=(8 << 20))
+        if invalid_raise:
+            parse_options = pacsv.ParseOptions(delimiter=delimiter)
+        else:
+            parse_options = pacsv.ParseOptions(delimiter=delimiter, invalid_row_handler=lambda row: 'skip')
+        names = columnnames if usecols is None else usecols
+        convert_options = pacsv.ConvertOptions(column_types={n: pa.float32() for n in names}, include_columns=names,
+                                               null_values=['', ' '], strings_can_be_null=True)
+        
+        # Use a plain OS file rather than a memory map. For large files which are not already in the page cache, large
+        # sequential block reads with kernel read-ahead outperform page-faulting through a memory map.
+        with pa.OSFile(self.filename, 'rb') as source:
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                except OSError:
+                    pass
+            
+            if self._data_offset is not None:
+                source.seek(self._data_offset)
+            
+            table = pacsv.read_csv(source, read_options=read_options, parse_options=parse_options,
+                                   convert_options=convert_options)
+        
+        # go straight to numpy rather than via a pandas DataFrame. Combining the chunks is the only copy - if a column only
+        # has one chunk and no nulls, we get a zero-copy view of the arrow buffer. Nulls (missing values) become NaN.
+        return {n: table.column(n).combine_chunks().to_numpy(zero_copy_only=False) for n in table.column_names}
+    
+    def _read_pandas(self, columnnames, delimiter, skiprows, skip_footer, invalid_raise, comments, usecols=None):
+        """ Parse using the pandas C tokenizer (substantially faster than np.genfromtxt on large files)"""
+        import pandas as pd
+        from PYME import config
+        
+        kwargs = {}
+        if skip_footer > 0:
+            # skipfooter is only supported by the (slow) python engine, so only ask for it when needed
+            kwargs['skipfooter'] = skip_footer
+            kwargs['engine'] = 'python'
+        else:
+            kwargs['engine'] = 'c'
+        
+        if skip_footer == 0:
+            # parse in chunks, discarding missing values as we go, so that we never hold more than one chunk of
+            # unfiltered data and the temporaries of the missing value check stay small (not supported with skipfooter)
+            kwargs['chunksize'] = config.get('TextFileSource-chunk_rows', 500000)
+        
+        kwargs.update(comment=comments,
+                      sep=delimiter if delimiter is not None else r'\s+', # match np.genfromtxt whitespace default
+                      skiprows=skiprows,
+                      header=None,
+                      names=columnnames,
+                      usecols=usecols,
+                      dtype='f4',
+                      skipinitialspace=True,
+                      on_bad_lines='error' if invalid_raise else 'warn')
+        
+        def _read(encoding):
+            with self._data_source() as source:
+                # memory map to avoid a userspace copy of the file contents (only possible when reading from the start)
+                reader = pd.read_csv(source, encoding=encoding, memory_map=isinstance(source, str), **kwargs)
+                if skip_footer > 0:
+                    # not chunked, we got a DataFrame back
+                    reader = [reader]
+                
+                chunks = []
+                n_dropped = 0
+                for df in reader:
+                    columns, n = _drop_missing_values({n: df[n].to_numpy(np.float32) for n in df.columns})
+                    chunks.append(columns)
+                    n_dropped += n
+            
+            return chunks, n_dropped
+        
+        encoding = self._sniff_encoding()
+        try:
+            chunks, n_dropped = _read(encoding)
+        except UnicodeDecodeError:
+            if encoding == 'latin-1':
+                raise
+            # non-ASCII characters after the sniffed region. Zeiss Elyra bombs unless we go for latin-1 encoding
+            chunks, n_dropped = _read('latin-1')
+        
+        if n_dropped > 0:
+            logger.warning('Text file contains missing values, discarding lines with missing values')
+        
+        if len(chunks) == 1:
+            return chunks[0]
+        
+        names = columnnames if usecols is None else usecols
+        return {n: np.concatenate([c[n] for c in chunks]) if chunks else np.empty(0, 'f4') for n in names}
+    
+    def _read_loadtxt(self, columnnames, delimiter, skiprows, comments, usecols=None):
+        """ Parse using np.loadtxt. Only use with numpy >= 1.23, where this is implemented in C."""
+        names = columnnames if usecols is None else usecols
+        with self._data_source() as source:
+            return np.loadtxt(source,
+                              comments=comments,
+                              delimiter=delimiter,
+                              skiprows=skiprows,
+                              usecols=None if usecols is None else [columnnames.index(n) for n in usecols],
+                              dtype=[(n, 'f4') for n in names],
+                              ndmin=1,
+                              encoding='latin-1')
+    
+    def _read_genfromtxt(self, columnnames, delimiter, skiprows, skip_footer, invalid_raise, comments, usecols=None):
+        """ Legacy parsing using np.genfromtxt"""
+        with self._data_source() as source:
+            return np.genfromtxt(source,
+                                 comments=comments,
+                                 delimiter=delimiter,
+                                 skip_header=skiprows,
+                                 skip_footer=skip_footer,
+                                 names=columnnames if usecols is None else usecols,
+                                 usecols=None if usecols is None else [columnnames.index(n) for n in usecols],
+                                 dtype='f4', replace_space='_',
+                                 missing_values=None, filling_values=np.nan, # use NaN to flag missing values
+                                 invalid_raise=invalid_raise,
+                                 encoding='latin-1') # Zeiss Elyra bombs unless we go for latin-1 encoding, maybe make flavour specific?
 
     def keys(self):
         return self._keys
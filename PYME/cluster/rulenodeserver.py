@@ -44,7 +44,11 @@ def template_fill(template, **kwargs):
 class Rater(object):
     def __init__(self, rule):
         self.rule = rule
-        self.taskIDs = rule['availableTaskIDs']
+        if 'availableTaskRanges' in rule:
+            # run length encoded advert (see 'ruleserver-advertise-ranges' config option)
+            self.taskIDs = [taskID for start, end in rule['availableTaskRanges'] for taskID in range(start, end)]
+        else:
+            self.taskIDs = rule['availableTaskIDs']
         self.template = rule['taskTemplate']
         inputs = rule.get('inputsByTask', {})
         self.inputs = {int(k):v for k, v in inputs.items()}
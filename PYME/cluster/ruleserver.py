@@ -37,6 +37,31 @@ import time
 import sys
 import ujson as json
 #import json
+try:
+    # orjson is considerably faster than ujson, and can serialise numpy arrays directly (saving a conversion to a list
+    # of python ints)
+    import orjson
+except ImportError:
+    orjson = None
+
+# _json_dumps() serialises to json bytes, _json_list() prepares a numpy array for serialisation (a no-op with orjson)
+if orjson is not None:
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    
+    _json_loads = orjson.loads
+    
+    def _json_list(a):
+        return a
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode()
+    
+    _json_loads = json.loads
+    
+    def _json_list(a):
+        return a.tolist()
+
 import os
 
 from PYME.misc import computerName
@@ -45,6 +70,8 @@ from PYME import resources
 #from PYME.IO import clusterIO
 from PYME.util import webframework
 import collections
+import heapq
+import itertools
 
 import uuid
 
@@ -59,6 +86,21 @@ Bid = collections.namedtuple('Bid', 'bidder_id, cost')
 
 DEFAULT_BID = Bid(0, sys.maxsize)
 
+# a consistent snapshot of the task counts for a rule (see `IntegerIDRule.snapshot()`)
+RuleCounts = collections.namedtuple('RuleCounts', 'nTotal, nAvailable, nAssigned, nCompleted, nFailed, n_timed_out, '
+                                                  'n_returned_after_timeout, avCost, n_max')
+
+def _task_ranges(task_ids):
+    """ Run length encode a sorted array of task IDs as a list of [start, end) ranges"""
+    if len(task_ids) == 0:
+        return []
+    
+    breaks = np.flatnonzero(np.diff(task_ids) != 1) + 1
+    starts = task_ids[np.r_[0, breaks]]
+    ends = task_ids[np.r_[breaks - 1, len(task_ids) - 1]] + 1
+    
+    return np.stack([starts, ends], axis=1).tolist()
+
 class IntegerIDRule(Rule):
     """
     A rule which generates tasks based on a template.
@@ -158,13 +200,19 @@ class IntegerIDRule(Rule):
     immediately.
         
     """
-    TASK_INFO_DTYPE = np.dtype([('status', 'uint8'), ('nRetries', 'uint8'), ('expiry', 'f4'), ('cost', 'f4')])
-    
     # task cost threshold below which tasks are deemed 'local' and directly awarded to the first bidder
     # rather than going to "auction" - ie. the "Buy Now" price
     # TODO - Revisit - should this be a settable rule parameter rather than a constant?
     COST_THRESHOLD = 0.2
     
+    # Rules are frequently created with a generous max_task_ID (e.g. when spooling a series of unknown length), so we
+    # start with (at most) this many task slots and grow the task info arrays geometrically as tasks are released.
+    INITIAL_TASK_CAPACITY = 10000
+    
+    # when generating adverts, find available tasks by scanning the status array (rather than from the set of available
+    # task IDs) if more than 1/DENSE_ADVERT_RATIO of the tasks are available
+    DENSE_ADVERT_RATIO = 32
+    
     
     def __init__(self, ruleID, task_template, inputs_by_task = None,
                  max_task_ID=100000, task_timeout=600, rule_timeout=3600, 
@@ -177,7 +225,29 @@ class IntegerIDRule(Rule):
             self._inputs_by_task = None
             
         self._template = task_template
-        self._task_info = np.zeros(max_task_ID, self.TASK_INFO_DTYPE)
+        
+        # per-task information, stored as separate arrays (rather than a single structured array) so that scans over
+        # the task status only need to touch the status bytes
+        # the arrays only cover the tasks released so far (see `_ensure_capacity()`), tasks above this are unavailable
+        self._max_task_ID = max_task_ID
+        capacity = min(max_task_ID, self.INITIAL_TASK_CAPACITY)
+        self._status = np.zeros(capacity, 'uint8')
+        self._retries = np.zeros(capacity, 'uint8') # number of times each task has been re-queued after timing out
+        self._expiry = np.zeros(capacity, 'f8') # time (time.monotonic()) at which an assigned task is deemed to have timed out
+        self._cost = np.zeros(capacity, 'f4')
+        # one past the highest task ID released so far. The (rare) full scans of the status array only need to look
+        # at tasks below this. NB - status is kept as one byte per task rather than bit-packed: there are 5 states (so
+        # 3 bits would be needed) and packing would slow down the per-task reads and writes in the hot paths.
+        self._n_released = 0
+        
+        # IDs of the tasks which are currently available, so that we don't need to scan the status array to generate adverts
+        self._available = set()
+        
+        # min-heap of (expiry, sequence #, task IDs) entries, one for each batch of tasks assigned in `bid()`, so that
+        # polling for timeouts only needs to look at the batches which have expired rather than scanning all tasks.
+        # Entries for tasks which are subsequently handed in are left in the heap and discarded when they expire.
+        self._assigned_expiry = []
+        self._assigned_expiry_seq = itertools.count() # tie-breaker, so we never compare the task ID arrays
         
         # Number of times to re-queue a task if it times out is set by the 'ruleserver-retries' config option
         # Setting a value of 0 effectively disables re-trying and makes analysis less robust.
@@ -195,7 +265,10 @@ class IntegerIDRule(Rule):
         self._timeout = task_timeout
         
         self._rule_timeout = rule_timeout
-        self._cached_advert = None
+        # Rather than taking out a separate lock to invalidate the cached advert, changes to the available tasks bump
+        # _advert_version (under _info_lock) and the advert is regenerated if the version it was built from is stale.
+        self._advert_version = 0
+        self._cached_advert = (-1, None, None, 0) # (version, advert, advert json, number of tasks advertised)
         self._active = True # making this rule inactive will cause it not to generate adverts (this is the closest we  get to aborting)
         self._seen_as_finished = False # flag to make sure completion logic only gets triggered once.
         
@@ -213,15 +286,20 @@ class IntegerIDRule(Rule):
         self.on_completion = on_completion
         
         self.avCost = 0
+        # running sum and count of the costs of tasks which have been assigned (or completed), for calculating avCost
+        self._cost_sum = 0.0
+        self._cost_n = 0
         
-        self.expiry = time.time() + self._rule_timeout
+        self.expiry = time.monotonic() + self._rule_timeout
         
         # store pending bids
         self._pending_bids = {}
         self._current_bidder_id = 0
               
         self._info_lock = threading.Lock()
-        self._advert_lock = threading.Lock()
+        self._publish_counts()
+        self._cached_info = (None, None) # (key, json) - see `info_json()`
+        self._info_json_key = _json_dumps(self.ruleID) + b':' # pre-encoded key for assembling queue info json
     
     def mark_release_complete(self, n_tasks=None):
         """
@@ -248,29 +326,98 @@ class IntegerIDRule(Rule):
                 if self.nTotal > n_tasks:
                         raise ValueError('n_tasks cannot be less than nTotal')
 
-                # extend _task_info array if necessary
+                # extend task info arrays if necessary
                 if n_tasks > self._n_max:
                    raise ValueError('n_tasks cannot be greater than max_task_ID')
 
                 self._n_max = n_tasks
             else:
                 self._n_max = self.nTotal
+            
+            # a one-off, so a convenient place to check our incrementally maintained counts haven't drifted
+            self._update_nums()
+            self._publish_counts()
        
         
     
         
     def _update_nums(self):
-        self.nAvailable = int((self._task_info['status'] == STATUS_AVAILABLE).sum())
-        self.nAssigned = int((self._task_info['status'] == STATUS_ASSIGNED).sum())
+        """
+        Recalculate the task counts from the task status array. These are maintained incrementally in the hot paths
+        (`bid()`, `make_range_available()`, etc ...) - this is an O(N) sanity check and should only be called rarely.
+        Must be called with `_info_lock` held.
+        """
+        # tally all the status values in a single pass
+        status = self._status[:self._n_released]
+        counts = np.bincount(status, minlength=5)
+        nAvailable = int(counts[STATUS_AVAILABLE])
+        nAssigned = int(counts[STATUS_ASSIGNED])
+        nCompleted = int(counts[STATUS_COMPLETE])
+        nFailed = int(counts[STATUS_FAILED])
+        nTotal = len(status) - int(counts[STATUS_UNAVAILABLE])
+        
+        if ((nAvailable, nAssigned, nCompleted, nFailed, nTotal) !=
+                (self.nAvailable, self.nAssigned, self.nCompleted, self.nFailed, self.nTotal)) or (nAvailable != len(self._available)):
+            logger.warning('Task counts for rule %s out of sync (nAvailable: %d vs %d, nAssigned: %d vs %d, '
+                           'nCompleted: %d vs %d, nFailed: %d vs %d, nTotal: %d vs %d), correcting' %
+                           (self.ruleID, self.nAvailable, nAvailable, self.nAssigned, nAssigned, self.nCompleted,
+                            nCompleted, self.nFailed, nFailed, self.nTotal, nTotal))
+            self.nAvailable = nAvailable
+            self.nAssigned = nAssigned
+            self.nCompleted = nCompleted
+            self.nFailed = nFailed
+            self.nTotal = nTotal
+            self._available = set(np.flatnonzero(status == STATUS_AVAILABLE).tolist())
+            self._advert_version += 1
+        
+    def _publish_counts(self):
+        """
+        Publish a snapshot of the task counts for `snapshot()`. Called at the end of each update (with `_info_lock` held)
+        so that readers never see the counts part way through an update.
+        """
+        self._counts = RuleCounts(self.nTotal, self.nAvailable, self.nAssigned, self.nCompleted, self.nFailed,
+                                  self.n_timed_out, self.n_returned_after_timeout, self.avCost, self._n_max)
+    
+    def snapshot(self):
+        """
+        Get a consistent snapshot of the task counts without taking any locks (the snapshot is replaced, rather than
+        modified, on update). Use this rather than reading several of the `nAvailable`, `nAssigned`, etc ... attributes
+        separately, which could catch a concurrent update half way through.
         
-    def _update_cost(self):
-        av_cost = np.mean(self._task_info['cost'][self._task_info['status'] > STATUS_AVAILABLE])
-        if np.isnan(av_cost):
-            av_cost = 0
-        else:
-            av_cost = float(av_cost)
-            
-        self.avCost = av_cost
+        Returns
+        -------
+        counts : RuleCounts
+            a named tuple with fields ``nTotal, nAvailable, nAssigned, nCompleted, nFailed, n_timed_out,
+            n_returned_after_timeout, avCost, n_max``
+        """
+        return self._counts
+        
+    def _update_cost(self, task_ids, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) the costs of the given tasks from the running average of the cost of all tasks
+        which have been assigned. Must be called with `_info_lock` held.
+        """
+        self._cost_sum += sign*float(self._cost[task_ids].sum(dtype='f8'))
+        self._cost_n += sign*len(task_ids)
+        
+        self.avCost = (self._cost_sum / self._cost_n) if self._cost_n > 0 else 0
+        
+    def _ensure_capacity(self, n_tasks):
+        """
+        Make sure the task info arrays can hold at least `n_tasks` tasks. Grows by (at least) a factor of 2 so that
+        releasing tasks a few at a time costs amortised O(N) copying rather than O(N^2). Must be called with
+        `_info_lock` held.
+        """
+        capacity = len(self._status)
+        if n_tasks <= capacity:
+            return
+        
+        new_capacity = min(max(n_tasks, 2*capacity), self._max_task_ID)
+        for name in ('_status', '_retries', '_expiry', '_cost'):
+            old = getattr(self, name)
+            new = np.zeros(new_capacity, old.dtype)
+            new[:capacity] = old
+            setattr(self, name, new)
         
     def make_range_available(self, start, end):
         """
@@ -288,21 +435,30 @@ class IntegerIDRule(Rule):
             if asked to release a range which is invalid for the max tasks we can create from this rule
         """
 
-        if start < 0 or start > self._task_info.size or end < 0 or end > self._task_info.size:
-            raise RuntimeError('Range (%d, %d) invalid with maxTasks=%d' % (start, end, self._task_info.size))
+        if start < 0 or start > self._max_task_ID or end < 0 or end > self._max_task_ID:
+            raise RuntimeError('Range (%d, %d) invalid with maxTasks=%d' % (start, end, self._max_task_ID))
         
-        #TODO - check existing status - it probably makes sense to only apply this to tasks which have STATUS_UNAVAILABLE
         with self._info_lock:
-            self._task_info['status'][start:end] = STATUS_AVAILABLE
+            self._ensure_capacity(end)
+            self._n_released = max(self._n_released, end)
             
-            self.nTotal = int((self._task_info['status'] >0).sum())
-        
-            self._update_nums()
+            # only release tasks which have not already been released, so that we can update our counts incrementally
+            # (looking only at the released range) rather than re-counting the whole status array.
+            status = self._status[start:end]
+            newly_available = status == STATUS_UNAVAILABLE
+            n_new = int(np.count_nonzero(newly_available))
+            status[newly_available] = STATUS_AVAILABLE
+            self._available.update((np.flatnonzero(newly_available) + start).tolist())
+            
+            self.nTotal += n_new
+            self.nAvailable += n_new
+            
+            if n_new > 0:
+                # only invalidate the advert if something changed (releases commonly overlap with previous ones)
+                self._advert_version += 1
+                self._publish_counts()
 
-        self.expiry = time.time() + self._rule_timeout
-        
-        with self._advert_lock:
-            self._cached_advert = None
+        self.expiry = time.monotonic() + self._rule_timeout
             
     def bid(self, bid):
         """Bid on tasks (and return any that match). Note the current implementation is very naive and doesn't
@@ -364,24 +520,69 @@ class IntegerIDRule(Rule):
         
         
         with self._info_lock:
-            successful_bid_mask = self._task_info['status'][taskIDs] == STATUS_AVAILABLE
+            if (len(taskIDs) > 0) and (taskIDs.max() >= len(self._status)):
+                # tasks beyond the end of our task arrays have not been released (and can't be won)
+                valid = taskIDs < len(self._status)
+                taskIDs, costs = taskIDs[valid], costs[valid]
+            
+            # clients generally bid on contiguous runs of task IDs, in which case we can use slices (contiguous reads and
+            # writes) rather than fancy indexing (gather / scatter)
+            is_range = (len(taskIDs) > 1) and (taskIDs[0] >= 0) and (int(taskIDs[-1] - taskIDs[0]) == (len(taskIDs) - 1)) \
+                       and np.all(np.diff(taskIDs) == 1)
+            
+            expiry = time.monotonic() + self._timeout
+            if is_range:
+                sl = slice(int(taskIDs[0]), int(taskIDs[-1]) + 1)
+                successful_bid_mask = self._status[sl] == STATUS_AVAILABLE
+            else:
+                successful_bid_mask = self._status[taskIDs] == STATUS_AVAILABLE
+            
             successful_bid_ids = taskIDs[successful_bid_mask]
-            self._task_info['status'][successful_bid_ids] = STATUS_ASSIGNED
-            self._task_info['cost'][successful_bid_ids] = costs[successful_bid_mask]
-            self._task_info['expiry'][successful_bid_ids] = time.time() + self._timeout
+            
+            if is_range and (len(successful_bid_ids) == len(taskIDs)):
+                # we won the whole range
+                self._status[sl] = STATUS_ASSIGNED
+                self._cost[sl] = costs
+                self._expiry[sl] = expiry
+            else:
+                self._status[successful_bid_ids] = STATUS_ASSIGNED
+                self._cost[successful_bid_ids] = costs[successful_bid_mask]
+                self._expiry[successful_bid_ids] = expiry
+            
+            self._available.difference_update(successful_bid_ids.tolist())
+            if len(successful_bid_ids) > 0:
+                heapq.heappush(self._assigned_expiry, (expiry, next(self._assigned_expiry_seq), successful_bid_ids))
             
             nTasks = len(successful_bid_ids)
             self.nAvailable -= nTasks
             self.nAssigned += nTasks
             
-            self._update_cost()
+            self._update_cost(successful_bid_ids)
+            
+            if nTasks > 0:
+                self._advert_version += 1
+                self._publish_counts()
 
-        self.expiry = time.time() + self._rule_timeout
-        
-        with self._advert_lock:
-            self._cached_advert = None
+        self.expiry = time.monotonic() + self._rule_timeout
             
-        return {'ruleID': bid['ruleID'], 'taskIDs':successful_bid_ids.tolist(), 'template' : self._template}
+        return {'ruleID': bid['ruleID'], 'taskIDs':_json_list(successful_bid_ids), 'template' : self._template}
+    
+    def check_handin(self, taskIDs, status):
+        """
+        Check that a handin is well formed before it is merged with others (see `RuleServer._apply_handins()`), so
+        that one bad handin can't prevent the rest of the batch being applied.
+        
+        Raises
+        ------
+        ValueError
+            if `taskIDs` and `status` have different lengths or any of the task IDs are out of range
+        """
+        if len(taskIDs) != len(status):
+            raise ValueError('taskIDs and status have different lengths (%d vs %d)' % (len(taskIDs), len(status)))
+        
+        # NB - tasks which have been released always lie within the status array
+        if len(taskIDs) > 0 and (min(taskIDs) < 0 or max(taskIDs) >= len(self._status)):
+            raise ValueError('task IDs out of range for rule %s' % self.ruleID)
     
     def mark_complete(self, info):
         """
@@ -401,30 +602,51 @@ class IntegerIDRule(Rule):
         """
         taskIDs = np.array(info['taskIDs'], 'i')
         status = np.array(info['status'], 'uint8')
-        
+
+        # merged handins may contain the same task more than once. Keep the last status for each task (as if the
+        # handins had been applied in order) and count the extra occurrences as repeats.
+        n_duplicates = 0
+        if len(taskIDs) > 1:
+            unique_ids, last_idx = np.unique(taskIDs[::-1], return_index=True)
+            n_duplicates = len(taskIDs) - len(unique_ids)
+            if n_duplicates > 0:
+                status = status[::-1][last_idx]
+                taskIDs = unique_ids
+
         with self._info_lock:
-            old_status = np.copy(self._task_info['status'][taskIDs])
-            self._task_info['status'][taskIDs] = status
+            old_status = np.copy(self._status[taskIDs])
+            self._status[taskIDs] = status
+            # tasks which timed out and were re-queued might be handed in by the original worker
+            returned_after_requeue = taskIDs[old_status == STATUS_AVAILABLE]
+            if len(returned_after_requeue) > 0:
+                self._available.difference_update(returned_after_requeue.tolist())
+                self._update_cost(returned_after_requeue)
+                self._advert_version += 1
+            
+            # tally old and new status values in one pass each
+            old_counts = np.bincount(old_status, minlength=5)
+            new_counts = np.bincount(status, minlength=5)
             
             # if tasks have timed out (or results have already been recieved), they will register as not assigned
-            n_not_assigned = int((old_status != STATUS_ASSIGNED).sum())
+            n_not_assigned = len(taskIDs) - int(old_counts[STATUS_ASSIGNED])
             
             # if we re-queue tasks after timeout we might receive answers from the re-queued tasks twice
-            n_already_complete = int((old_status == STATUS_COMPLETE).sum())
-            n_already_failed = int((old_status == STATUS_FAILED).sum())
+            n_already_complete = int(old_counts[STATUS_COMPLETE])
+            n_already_failed = int(old_counts[STATUS_FAILED])
             
             
-            self.nCompleted += (int((status == STATUS_COMPLETE).sum()) - n_already_complete)
-            self.nFailed += (int((status == STATUS_FAILED).sum()) - n_already_failed)
+            self.nCompleted += (int(new_counts[STATUS_COMPLETE]) - n_already_complete)
+            self.nFailed += (int(new_counts[STATUS_FAILED]) - n_already_failed)
             
-            self.n_repeats += (n_already_complete + n_already_failed)
-            self.n_returned_after_timeout += n_not_assigned
+            self.n_repeats += (n_already_complete + n_already_failed + n_duplicates)
+            self.n_returned_after_timeout += (n_not_assigned + n_duplicates)
             self.nAvailable -= (n_not_assigned - (n_already_complete + n_already_failed))
             
             nTasks = len(taskIDs) - n_not_assigned#(n_already_complete + n_already_failed)
             self.nAssigned -= nTasks
+            self._publish_counts()
 
-        self.expiry = time.time() + self._rule_timeout
+        self.expiry = time.monotonic() + self._rule_timeout
             
     @property
     def advert(self):
@@ -434,49 +656,93 @@ class IntegerIDRule(Rule):
         ``{"ruleID" : str, "taskTemplate" : str, "availableTaskIDs" : [list of int], "inputsByTask" : [optional] dict mapping task IDs to inputs}``
         
         "inputsByTask" is only provided for some recipe tasks.
+        
+        If the 'ruleserver-advertise-ranges' config option is set, "availableTaskIDs" is replaced by a run length encoded
+        "availableTaskRanges" : [list of [start, end) pairs]. As tasks are generally released in contiguous blocks, this
+        is dramatically smaller, but requires all the nodes in the cluster to understand it.
         """
+        return self._get_advert()[0]
+    
+    @property
+    def advert_json(self):
+        """ The task advertisement, serialised to json (or None if no tasks are available). Cached along with the advert,
+        so that unchanged rules don't need to re-serialise their (potentially very long) lists of task IDs every time we
+        generate adverts."""
+        return self._get_advert()[1]
+    
+    def _get_advert(self):
+        """ Get the (cached) advert, its json serialisation, and the number of tasks advertised as a consistent tuple"""
         if not self._active:
-            return None
+            return None, None, 0
         
-        with self._advert_lock:
-            if not self._cached_advert:
-                availableTasks = np.where(self._task_info['status'] == STATUS_AVAILABLE)[0].tolist()
+        cached = self._cached_advert
+        if cached[0] != self._advert_version:
+            with self._info_lock:
+                version = self._advert_version
+                if len(self._available) * self.DENSE_ADVERT_RATIO > self._n_released:
+                    # lots of available tasks - a vectorised scan of the status array is cheaper than iterating the
+                    # set, and gives us the IDs already sorted
+                    availableTasks = np.flatnonzero(self._status[:self._n_released] == STATUS_AVAILABLE)
+                else:
+                    availableTasks = np.sort(np.fromiter(self._available, 'i', len(self._available)))
+            
+            
+            if len(availableTasks) == 0:
+                advert, advert_json = None, None
+            else:
+                advert = {'ruleID' : self.ruleID,
+                    'taskTemplate': self._template}
                 
-                if len(availableTasks) == 0:
-                    self._cached_advert = None
+                if config.get('ruleserver-advertise-ranges', False):
+                    advert['availableTaskRanges'] = _task_ranges(availableTasks)
                 else:
-                    self._cached_advert = {'ruleID' : self.ruleID,
-                        'taskTemplate': self._template,
-                        'availableTaskIDs': availableTasks}
-                    
-                    #print self._inputs_by_task
-                    
-                    if not self._inputs_by_task is None:
-                        self._cached_advert['inputsByTask'] = {taskID: self._inputs_by_task[taskID] for taskID in availableTasks}
+                    advert['availableTaskIDs'] = _json_list(availableTasks)
+                
+                #print self._inputs_by_task
+                
+                if not self._inputs_by_task is None:
+                    advert['inputsByTask'] = {taskID: self._inputs_by_task[taskID] for taskID in availableTasks.tolist()}
                 
-            return self._cached_advert
+                advert_json = _json_dumps(advert)
+            
+            # replace the whole tuple in one (atomic) assignment so that readers always see a consistent advert. If two
+            # threads race to regenerate, the worst case is that a stale advert gets stored and is regenerated next time.
+            cached = (version, advert, advert_json, len(availableTasks))
+            self._cached_advert = cached
+        
+        return cached[1:]
     
     # @property
     # def nAvailable(self):
-    #     return (self._task_info['status'] == STATUS_AVAILABLE).sum()
+    #     return (self._status == STATUS_AVAILABLE).sum()
     #
     # @property
     # def nAssigned(self):
-    #     return (self._task_info['status'] == STATUS_ASSIGNED).sum()
+    #     return (self._status == STATUS_ASSIGNED).sum()
 
     # @property
     # def nCompleted(self):
-    #     return (self._task_info['status'] == STATUS_COMPLETE).sum()
+    #     return (self._status == STATUS_COMPLETE).sum()
 
     # @property
     # def nFailed(self):
-    #     return (self._task_info['status'] == STATUS_FAILED).sum()
+    #     return (self._status == STATUS_FAILED).sum()
 
     
+    @property
+    def next_task_expiry(self):
+        """ The earliest time at which an assigned task could time out (inf if no tasks are assigned). Cheap, so can be
+        used to decide whether `poll_timeouts()` needs to be called."""
+        try:
+            return self._assigned_expiry[0][0]
+        except IndexError:
+            return float('inf')
+    
     @property
     def expired(self):
         """ Whether the rule has expired (no available tasks, no tasks assigned, and time > expiry) and can be removed"""
-        return (self.nAvailable == 0) and (self.nAssigned == 0) and (time.time() > self.expiry)
+        counts = self._counts
+        return (counts.nAvailable == 0) and (counts.nAssigned == 0) and (time.monotonic() > self.expiry)
     
     @property
     def finished(self):
@@ -487,10 +753,11 @@ class IntegerIDRule(Rule):
         # TODO - change this so that we can release starting at task_ID > 0???? 
         # TODO - make rules finish when some tasks fail.
         
-        # To fix: Potentially replace with `np.all(self._task_info['status']>=STATUS_COMPLETE)` (although this would need to be cached and refreshed - property access should be cheap). 
-        # combined with a new enum value STATUS_INVALID==6 -  `self.mark_release_complete()` could be re-written as `self._task_info['status'][self._task_info['status'] == 0] = STATUS_INVALID`
+        # To fix: Potentially replace with `np.all(self._status>=STATUS_COMPLETE)` (although this would need to be cached and refreshed - property access should be cheap). 
+        # combined with a new enum value STATUS_INVALID==6 -  `self.mark_release_complete()` could be re-written as `self._status[self._status == 0] = STATUS_INVALID`
         
-        return (self.nAvailable == 0) and ((self.nCompleted + self.nFailed) >= self._n_max)
+        counts = self._counts
+        return (counts.nAvailable == 0) and ((counts.nCompleted + counts.nFailed) >= counts.n_max)
     
     def inactivate(self):
         """
@@ -510,44 +777,70 @@ class IntegerIDRule(Rule):
             ``{'tasksPosted': int, 'tasksRunning': int, 'tasksCompleted': int, 'tasksFailed' : int, 'averageExecutionCost' : float}``
 
         """
-        return {'tasksPosted': self.nTotal,
-                  'tasksRunning': self.nAssigned,
-                  'tasksCompleted': self.nCompleted,
-                  'tasksFailed' : self.nFailed,
-                  'averageExecutionCost' : self.avCost,
+        counts = self._counts
+        return {'tasksPosted': counts.nTotal,
+                  'tasksRunning': counts.nAssigned,
+                  'tasksCompleted': counts.nCompleted,
+                  'tasksFailed' : counts.nFailed,
+                  'averageExecutionCost' : counts.avCost,
                   'active' : self._active,
-                  'tasksTimedOut' : self.n_timed_out,
-                  'tasksCompleteAfterTimeout' : self.n_returned_after_timeout,
+                  'tasksTimedOut' : counts.n_timed_out,
+                  'tasksCompleteAfterTimeout' : counts.n_returned_after_timeout,
                   'finished' : self.finished,
                   'expired' : self.expired,
                 }
     
+    def info_json(self):
+        """
+        The json serialisation of `info()` (as bytes). This is cached, and only re-serialised when the info changes.
+        """
+        key = (self._counts, self._active, self.finished, self.expired)
+        cached = self._cached_info
+        if cached[0] != key:
+            cached = (key, _json_dumps(self.info()))
+            self._cached_info = cached
+        
+        return cached[1]
+    
     def poll_timeouts(self):
-        t = time.time()
+        t = time.monotonic()
         
         with self._info_lock:
-            timed_out = np.where((self._task_info['status'] == STATUS_ASSIGNED)*(self._task_info['expiry'] < t))[0]
+            expired = []
+            while self._assigned_expiry and (self._assigned_expiry[0][0] < t):
+                expired.append(heapq.heappop(self._assigned_expiry)[2])
             
+            if len(expired) > 0:
+                # normally only one batch has expired since the last poll, in which case we can skip the concatenation
+                candidates = np.unique(expired[0] if (len(expired) == 1) else np.concatenate(expired))
+                # skip tasks which have since been handed in, or have been re-assigned with a later expiry
+                timed_out = candidates[(self._status[candidates] == STATUS_ASSIGNED) & (self._expiry[candidates] < t)]
+            else:
+                timed_out = np.zeros(0, 'i')
             
             nTimedOut = len(timed_out)
             if nTimedOut > 0:
-                self._task_info['status'][timed_out] = STATUS_AVAILABLE
-                self._task_info['nRetries'][timed_out] += 1
+                self._status[timed_out] = STATUS_AVAILABLE
+                # gather the retry counts once, rather than once for the increment and once for the comparison
+                retries = self._retries[timed_out] + 1
+                self._retries[timed_out] = retries
                 
                 self.nAssigned -= nTimedOut
                 self.nAvailable += nTimedOut
                 
                 self.n_timed_out += nTimedOut
     
-                retry_failed = self._task_info['nRetries'][timed_out] > self._n_retries
-                self._task_info['status'][timed_out[retry_failed]] = STATUS_FAILED
-                self.nAvailable -= int(retry_failed.sum())
-                self.nFailed += int(retry_failed.sum())
+                retry_failed = retries > self._n_retries
+                self._status[timed_out[retry_failed]] = STATUS_FAILED
+                requeued = timed_out[~retry_failed]
+                self._available.update(requeued.tolist())
+                self._update_cost(requeued, -1)
+                n_failed = int(np.count_nonzero(retry_failed))
+                self.nAvailable -= n_failed
+                self.nFailed += n_failed
                 
-                #self._update_nums()
-            
-        with self._advert_lock:
-            self._cached_advert = None
+                self._advert_version += 1
+                self._publish_counts()
         
         
     
@@ -556,6 +849,8 @@ class IntegerIDRule(Rule):
 
 class RuleServer(object):
     MAX_ADVERTISEMENTS = 5 * 10 * 50 * 12 #only advertise enough for 100 tasks on each core of each cluster node
+    RULE_POLL_INTERVAL = 5 # maximum interval (in s) between checks for finished / expired rules
+    LONGPOLL_TIMEOUT = 5 # maximum time (in s) that /queue_info_longpoll waits for something to change
     def __init__(self):
         self._rules = collections.OrderedDict()
         
@@ -573,11 +868,17 @@ class RuleServer(object):
         
         self._cached_advert = None
         self._cached_advert_expiry = 0
+        self._advert_cursor = 0 # index of the rule to start advertising from (see `task_advertisements()`)
         
         
-        self._info_lock = threading.Lock()
-        self._cached_info = None
-        self._cached_info_expiry = 0
+        self._info_lock = threading.Lock() # held while rebuilding the queue info
+        # (info json, expiry, per-rule info json fragments it was built from, state version, version of the info json)
+        # - see `get_queues()`
+        self._cached_info = (None, 0, None, -1, -1)
+        # changed (by `_rules_changed()`) whenever rules are added / removed or their state changes
+        self._state_counter = itertools.count()
+        self._state_version = next(self._state_counter)
+        self._state_condition = threading.Condition() # notified on state changes, for long-polling
         self._cached_info_timeout = 5
         self._finished_rule_timeout = 60 # keep finished rules around for a minute (so we can see them in the GUI)
         self._failed_finished_rule_timeout = 5*60 # keep rules with failures around for 5 mins to give us a chance to look at errors
@@ -585,10 +886,20 @@ class RuleServer(object):
         self._rule_n = 0
         
         self._rule_lock = threading.Lock() # lock for when we modify the dictionary of rules
+        self._rules_gen = 0 # incremented (under _rule_lock) whenever rules are added or removed
         
+        self._poll_wakeup = threading.Event() # set on stop() so the poll thread exits promptly
         self.rulePollThread = threading.Thread(target=self._poll_rules)
         self.rulePollThread.start()
         
+        # handins are (by default) applied to the rules by a separate thread so that the handin endpoint can return
+        # immediately, and so that handins arriving close together get batched
+        self._async_handin = config.get('ruleserver-async-handin', True)
+        self._handin_queue = Queue.SimpleQueue()
+        if self._async_handin:
+            self.handinThread = threading.Thread(target=self._process_handins)
+            self.handinThread.start()
+        
         with open(os.path.join(resources.get_web_dir(),  'ruleserver.html'), 'r') as f:
             self._status_page = f.read()
     
@@ -599,56 +910,197 @@ class RuleServer(object):
     
     def _poll_rules(self):
         while self._do_poll:
-            for qn in list(self._rules.keys()):
-                self._rules[qn].poll_timeouts()
+            t = time.monotonic()
+            # we check for finished and expired rules at least every RULE_POLL_INTERVAL seconds, but wake up earlier if
+            # a task is due to time out
+            next_poll = t + self.RULE_POLL_INTERVAL
+            
+            # walk the rules dictionary directly rather than copying the keys on each pass. Rules are only added or
+            # removed (under _rule_lock) in add_integer_id_rule() and below, both of which bump _rules_gen. If this
+            # happens while we are iterating we abandon the pass and start a new one straight away.
+            gen = self._rules_gen
+            new_rules = []
+            expired_rules = []
+            restart = False
+            state_changed = False
+            items = iter(self._rules.items())
+            while True:
+                # only the iteration itself is guarded against concurrent modification - errors in rule code are
+                # handled (and logged) separately below
+                try:
+                    qn, r = next(items)
+                except StopIteration:
+                    break
+                except RuntimeError:
+                    # dictionary was modified by another thread between our generation check and the next step
+                    restart = True
+                    break
+                
+                if self._rules_gen != gen:
+                    restart = True
+                    break
                 
-                # look for rules that have processed all tasks
-                if self._rules[qn].finished:
-                    #with self._rule_lock:
-                    #    r = self._rules.pop(qn)
+                try:
+                    if self._poll_rule(qn, r, t, new_rules, expired_rules):
+                        state_changed = True
                     
-                    r = self._rules[qn]
-                    if not r._seen_as_finished:
-                        r._seen_as_finished = True # prevent following logic from executing twice
-
-                        # shorten rule expiry (no need to keep lots of finished rules in memory)
-                        if r.nFailed > 0:
-                            # Allow a little more time if we have errors so we can click through to the diagnostics (TODO)
-                            r.expiry = time.time() + self._failed_finished_rule_timeout
-                        else:
-                            # Allow some time so that rules can be seen as complete in the GUI
-                            r.expiry = time.time() + self._finished_rule_timeout
-                        
-                        follow_on = r.on_completion
-                        if follow_on is not None:
-                            # if a follow on rule is defined, add it
-                            template = follow_on['template']
-                            n_tasks = follow_on.get('max_tasks', 1)
-                            timeout = follow_on.get('rule_timeout', 3600.)
-                            ruleID = '%06d-%s' % (self._rule_n, uuid.uuid4().hex)
-        
-                            rule = IntegerIDRule(ruleID, template, max_task_ID=int(n_tasks),
-                                                rule_timeout=float(timeout), on_completion=follow_on.get('on_completion', None))
-        
-                            rule.make_range_available(0, int(n_tasks))
-        
-                            with self._rule_lock:
-                                self._rules[ruleID] = rule
-        
-                            self._rule_n += 1
+                    next_poll = min(next_poll, r.next_task_expiry)
+                except Exception:
+                    logger.exception('Error polling rule %s' % qn)
+            
+            if new_rules or expired_rules:
+                with self._rule_lock:
+                    for rule in new_rules:
+                        self._rules[rule.ruleID] = rule
                     
+                    for qn in expired_rules:
+                        logger.debug('removing expired rule: %s' % qn)
+                        self._rules.pop(qn, None)
+                    
+                    self._rules_gen += 1
+                
+                state_changed = True
+            
+            if state_changed:
+                self._rules_changed()
+            
+            if restart:
+                continue
+            
+            # NB - don't spin if we are running behind
+            self._poll_wakeup.wait(max(next_poll - time.monotonic(), 0.1))
+    
+    def _poll_rule(self, qn, r, t, new_rules, expired_rules):
+        """
+        Check a single rule for task timeouts, completion, and expiry (called from `_poll_rules()`). Follow-on rules
+        and the IDs of expired rules are appended to ``new_rules`` and ``expired_rules`` respectively, rather than
+        modifying the rules dictionary directly.
+        
+        Returns
+        -------
+        state_changed : bool
+            whether the state of the rule changed
+        """
+        state_changed = False
+        if r.next_task_expiry < t:
+            counts = r.snapshot()
+            r.poll_timeouts()
+            if r.snapshot() is not counts:
+                state_changed = True
+        
+        # look for rules that have processed all tasks
+        if r.finished and not r._seen_as_finished:
+            r._seen_as_finished = True # prevent following logic from executing twice
+            state_changed = True
+            
+            # shorten rule expiry (no need to keep lots of finished rules in memory)
+            if r.nFailed > 0:
+                # Allow a little more time if we have errors so we can click through to the diagnostics (TODO)
+                r.expiry = t + self._failed_finished_rule_timeout
+            else:
+                # Allow some time so that rules can be seen as complete in the GUI
+                r.expiry = t + self._finished_rule_timeout
+            
+            follow_on = r.on_completion
+            if follow_on is not None:
+                # if a follow on rule is defined, add it (after we are done iterating)
+                template = follow_on['template']
+                n_tasks = follow_on.get('max_tasks', 1)
+                timeout = follow_on.get('rule_timeout', 3600.)
+                ruleID = '%06d-%s' % (self._rule_n, uuid.uuid4().hex)
+                
+                rule = IntegerIDRule(ruleID, template, max_task_ID=int(n_tasks),
+                                     rule_timeout=float(timeout), on_completion=follow_on.get('on_completion', None))
                 
-                #remore queue if expired (no activity for an hour) to free up memory
-                if self._rules[qn].expired:
-                    logger.debug('removing expired rule: %s' % self._rules[qn].ruleID)
-                    with self._rule_lock:
-                        r = self._rules.pop(qn)
-                        
+                rule.make_range_available(0, int(n_tasks))
+                new_rules.append(rule)
+                
+                self._rule_n += 1
+        
+        #remove queue if expired (no activity for an hour) to free up memory
+        if r.expired:
+            expired_rules.append(qn)
+        
+        return state_changed
+    
+    def _process_handins(self):
+        while self._do_poll:
+            try:
+                handins = self._handin_queue.get(timeout=1)
+            except Queue.Empty:
+                continue
             
-            time.sleep(5)
+            self._apply_queued_handins(handins)
+        
+        # clients have already been told that their handins succeeded, so apply anything still queued when we stop
+        self._apply_queued_handins([])
+    
+    def _apply_queued_handins(self, handins):
+        # grab everything else which has arrived in the meantime
+        try:
+            while True:
+                handins.extend(self._handin_queue.get_nowait())
+        except Queue.Empty:
+            pass
+        
+        if len(handins) == 0:
+            return
+        
+        try:
+            self._apply_handins(handins)
+        except:
+            logger.exception('Error applying handins')
+    
+    def _apply_handins(self, handins):
+        """
+        Mark tasks as complete. Handins are grouped by rule so that we only call mark_complete() (and take out the
+        rule lock) once per rule.
+        
+        Parameters
+        ----------
+        handins : list
+            A list of ``{"ruleID": str, "taskIDs" : [list of int], "status" : [list of int]}`` dictionaries
+        """
+        handins_by_rule = collections.OrderedDict()
+        for handin in handins:
+            try:
+                ruleID = handin['ruleID']
+                try:
+                    rule = self._rules[ruleID]
+                except KeyError:  # rule may have expired
+                    continue
+                
+                # validate each handin individually, so that a bad one only loses its own tasks
+                rule.check_handin(handin['taskIDs'], handin['status'])
+                
+                _, taskIDs, status = handins_by_rule.setdefault(ruleID, (rule, [], []))
+                taskIDs.extend(handin['taskIDs'])
+                status.extend(handin['status'])
+            except Exception as e:
+                logger.error('Discarding invalid handin (%s): %s' % (e, handin))
+        
+        # apply each rule separately so that an error in one rule doesn't lose the handins for the others
+        for ruleID, (rule, taskIDs, status) in handins_by_rule.items():
+            try:
+                rule.mark_complete({'ruleID': ruleID, 'taskIDs': taskIDs, 'status': status})
+            except Exception:
+                logger.exception('Error applying handins for rule %s' % ruleID)
+        
+        self._rules_changed()
+    
+    def _rules_changed(self):
+        """
+        Record that rules have been added / removed or their state has changed (call *after* making the change). Used
+        to avoid rebuilding the queue info when nothing has changed.
+        """
+        # NB - next() on an itertools.count is atomic under the GIL, unlike += on an attribute
+        self._state_version = next(self._state_counter)
+        with self._state_condition:
+            self._state_condition.notify_all()
     
     def stop(self):
         self._do_poll = False
+        self._poll_wakeup.set()
         
         #for queue in self._queues.values():
         #    queue.stop()
@@ -669,24 +1121,35 @@ class RuleServer(object):
 
         """
         with self._advert_lock:
-            t = time.time()
+            t = time.monotonic()
             if (t > self._cached_advert_expiry):
                 adverts = []
                 nTasks = 0
-                ruleN = 0
                 
+                # Start where we left off last time (round-robin) so that, if we hit MAX_ADVERTISEMENTS, the rules at
+                # the front of the queue don't starve those behind them.
                 rules = list(self._rules.values())
-                while ruleN < len(rules) and nTasks < self.MAX_ADVERTISEMENTS:
-                    advert = rules[ruleN].advert
+                n_rules = len(rules)
+                start = (self._advert_cursor % n_rules) if n_rules > 0 else 0
+                for i in range(n_rules):
+                    rule = rules[(start + i) % n_rules]
+                    if (rule.nAvailable == 0) or not rule._active:
+                        # cheap check to skip rules with nothing to advertise
+                        continue
+                    
+                    # use the pre-serialised adverts so that we only pay for serialisation when a rule changes
+                    advert, advert_json, n_advertised = rule._get_advert()
                     
                     if not advert is None:
-                        adverts.append(advert)
-                        nTasks += len(advert['availableTaskIDs'])
-                        
-                    ruleN += 1
+                        adverts.append(advert_json)
+                        nTasks += n_advertised
                     
-                self._cached_advert = json.dumps(adverts)
-                self._cached_advert_expiry = time.time() + 1 #regenerate advert once every second
+                    if nTasks >= self.MAX_ADVERTISEMENTS:
+                        self._advert_cursor = (start + i + 1) % n_rules
+                        break
+                    
+                self._cached_advert = b'[' + b','.join(adverts) + b']'
+                self._cached_advert_expiry = t + 1 #regenerate advert once every second
             
         return self._cached_advert
         
@@ -711,7 +1174,7 @@ class RuleServer(object):
             See :meth:`IntegerIDTask.bid`
 
         """
-        bids = json.loads(body)
+        bids = _json_loads(body)
         
         succesfull_bids = []
         
@@ -721,9 +1184,11 @@ class RuleServer(object):
             succesfull_bids.append(rule.bid(bid))
             #task_ids = bid['taskIDs']
             #costs = bid['taskCosts']
+        
+        self._rules_changed()
             
         #print(succesfull_bids)
-        return json.dumps(succesfull_bids)
+        return _json_dumps(succesfull_bids)
         
             
         
@@ -767,7 +1232,7 @@ class RuleServer(object):
         with self._rule_lock:
             # lock ~entire call so we don't hit KeyErrors if clients immediately
             # try to abort/mark datasource complete, etc. after posting
-            rule_info = json.loads(body)
+            rule_info = _json_loads(body)
             
             if ruleID is None:
                 ruleID = '%06d-%s' % (self._rule_n, uuid.uuid4().hex)
@@ -781,10 +1246,12 @@ class RuleServer(object):
             
 
             self._rules[ruleID] = rule
+            self._rules_gen += 1
         
         self._rule_n += 1
+        self._rules_changed()
         
-        return json.dumps({'ok': 'True', 'ruleID' : ruleID})
+        return _json_dumps({'ok': 'True', 'ruleID' : ruleID})
 
     @webframework.register_endpoint('/release_rule_tasks')
     def release_rule_tasks(self, ruleID, release_start, release_end, body=''):
@@ -819,9 +1286,9 @@ class RuleServer(object):
         logger.debug('release_rule_tasks(ruleID = %s, release_start=%d, release_end=%d)' % (ruleID, int(release_start), int(release_end )))
         
         rule.make_range_available(int(release_start), int(release_end))
+        self._rules_changed()
     
-    
-        return json.dumps({'ok': 'True'})
+        return _json_dumps({'ok': 'True'})
     
     @webframework.register_endpoint('/inactivate_rule')
     def inactivate_rule(self, ruleID):
@@ -829,8 +1296,9 @@ class RuleServer(object):
             # take out the lock in case the rule is still being added in another
             # request and we are already trying to abort
             self._rules[ruleID].inactivate()
-
-        return json.dumps({'ok': 'True'})
+        
+        self._rules_changed()
+        return _json_dumps({'ok': 'True'})
     
     @webframework.register_endpoint('/handin')
     def handin(self, body):
@@ -850,24 +1318,27 @@ class RuleServer(object):
         success : json str
             ``{"ok" : "True"}`` if successful.
         
+        Notes
+        -----
+        Unless the 'ruleserver-async-handin' config option is False, tasks are marked as complete asynchronously (by a
+        separate thread) after this returns.
 
         """
         
         #logger.debug('Handing in tasks...')
-        expired_rules = set()
-        for handin in json.loads(body):
-            ruleID = handin['ruleID']
-            try:
-                rule = self._rules[ruleID]
-                rule.mark_complete(handin)
-            except KeyError:  # rule may have expired
-                expired_rules.add(ruleID)
+        handins = _json_loads(body)
+        expired_rules = {handin['ruleID'] for handin in handins if handin['ruleID'] not in self._rules}
+        
+        if self._async_handin:
+            self._handin_queue.put(handins)
+        else:
+            self._apply_handins(handins)
         
         if len(expired_rules) == 0:
-            return json.dumps({'ok': 'True'})
+            return _json_dumps({'ok': 'True'})
         else:
             # rulenodeserver currently ignores what we say here other than 'ok'
-            return json.dumps({'ok': 'False', 'error': str(expired_rules)})
+            return _json_dumps({'ok': 'False', 'error': str(expired_rules)})
     
     @webframework.register_endpoint('/mark_release_complete')
     def mark_release_complete(self, ruleID, n_tasks=None):
@@ -904,7 +1375,9 @@ class RuleServer(object):
         # client POSTs this (e.g. if a series is started/stopped quickly)
         with self._rule_lock:
             self._rules[ruleID].mark_release_complete(n_tasks)
-        return json.dumps({'ok': 'True'})
+        
+        self._rules_changed()
+        return _json_dumps({'ok': 'True'})
     
     @webframework.register_endpoint('/distributor/queues')
     def get_queues(self):
@@ -915,29 +1388,83 @@ class RuleServer(object):
         -------
         
         status: json str
-            A dictionary of the form ``{"ok" : True, "result" : {ruleID0 : rule0.info(), ruleID1 : rule1.info()}}``
-            See :meth:`IntegerIDRule.info`.
+            A dictionary of the form
+            ``{"ok" : True, "version" : int, "result" : {ruleID0 : rule0.info(), ruleID1 : rule1.info()}}``
+            See :meth:`IntegerIDRule.info`. ``version`` changes whenever the result does (see :meth:`get_queue_info`).
         """
-        with self._info_lock:
-            t = time.time()
-            if (t > self._cached_info_expiry):
-                with self._rule_lock:
-                    self._cached_info = json.dumps({'ok': True, 'result': {qn: self._rules[qn].info() for qn in self._rules.keys()}})
-                self._cached_info_expiry = time.time() + self._cached_info_timeout
+        info, expiry, fragments, version, info_version = self._cached_info
+        if version == self._state_version:
+            # nothing has changed
+            return info
+        
+        t = time.monotonic()
+        # only one thread rebuilds at a time, everyone else gets the (slightly stale) cached info without waiting
+        if (t > expiry) and self._info_lock.acquire(blocking=(info is None)):
+            try:
+                # read the version before looking at the rules, so that any changes made while we are building are
+                # picked up next time
+                version = self._state_version
+
+                # NB - copying the values of a dict is atomic under the GIL, so we don't need the _rule_lock
+                rules = list(self._rules.values())
                 
-        return self._cached_info
+                # assemble the response from each rule's cached info json, only re-joining if something changed
+                new_fragments = [(rule._info_json_key, rule.info_json()) for rule in rules]
+                if (fragments is None) or (len(new_fragments) != len(fragments)) or \
+                        any((k is not ck) or (f is not cf) for (k, f), (ck, cf) in zip(new_fragments, fragments)):
+                    info_version = version
+                    info = b'{"ok":true,"version":%d,"result":{' % info_version + \
+                           b','.join(k + f for k, f in new_fragments) + b'}}'
+                
+                # replace the whole tuple in one (atomic) assignment so that readers always see a consistent cache
+                self._cached_info = (info, t + self._cached_info_timeout, new_fragments, version, info_version)
+            finally:
+                self._info_lock.release()
+        
+        return info
     
     @webframework.register_endpoint('/queue_info_longpoll')
-    def get_queue_info(self):
+    def get_queue_info(self, version=None):
         """
-        a throttled version of queue info
+        A long-polling version of queue info. Waits (for up to LONGPOLL_TIMEOUT s) for the queue info to differ from
+        the version the client last saw before returning it.
+        
+        NB - this used to return after a fixed 0.5 s sleep. Clients now get changes as soon as they happen, but an
+        idle server holds each request for up to LONGPOLL_TIMEOUT (5 s).
+        
+        Parameters
+        ----------
+        version : str, optional
+            The ``version`` field of the last queue info the client received. If omitted, we wait for a change from
+            whatever the server currently has cached, which can miss a change made since the client's last poll.
         
         Returns
         -------
-
+        
+        status: json str
+            See :meth:`get_queues`
         """
-        time.sleep(0.5)
-        return self.get_queues()
+        seen_version = self._cached_info[4] if version is None else int(version)
+        
+        deadline = time.monotonic() + self.LONGPOLL_TIMEOUT
+        while True:
+            state_version = self._state_version
+            self.get_queues()
+            
+            # look at the cache directly (rather than what get_queues() returned) so that info and info_version are
+            # consistent if another thread rebuilt the info in the meantime
+            info, expiry, _, cached_version, info_version = self._cached_info
+            t = time.monotonic()
+            if (info_version != seen_version) or (t >= deadline):
+                return info
+            elif cached_version != self._state_version:
+                # something has changed, but the queue info was rebuilt recently (see `get_queues()`). Wait until it
+                # can be rebuilt, rather than spinning.
+                time.sleep(max(min(expiry, deadline) - t, 0.01))
+            else:
+                with self._state_condition:
+                    if self._state_version == state_version:
+                        self._state_condition.wait(deadline - t)
     
     @webframework.register_endpoint('/', mimetype='text/html')
     def status(self):
@@ -1050,7 +1577,8 @@ class ServerThread(threading.Thread):
         try:
             self.distributor.serve_forever()
         finally:
-            self.distributor._do_poll = False
+            # stop() also wakes the rule polling thread, so we don't wait out a full poll interval
+            self.distributor.stop()
             #logger.info('Shutting down ...')
             #self.distributor.shutdown()
             logger.info('Closing server ...')
@@ -1061,7 +1589,7 @@ class ServerThread(threading.Thread):
             
     
     def shutdown(self):
-        self.distributor._do_poll = False
+        self.distributor.stop()
         logger.info('Shutting down ...')
         self.distributor.shutdown()
         logger.info('Closing server ...')
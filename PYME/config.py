@@ -214,6 +214,14 @@ This is a non-exhaustive list of configuration keys - if adding a new key, pleas
 
     ruleserver-retries, default = 3, [new-style task distribution]. The number of times to retry a given task before it is deemed to have failed.
 
+    ruleserver-async-handin, default=True, "[new-style task distribution]. Return from the ruleserver handin endpoint
+    immediately, and update task status from a separate thread (batching handins which arrive close together). Set to
+    False to update task status before returning."
+
+    ruleserver-advertise-ranges, default=False, "[new-style task distribution]. Advertise available tasks as ranges of
+    task IDs rather than listing every ID. Much smaller adverts for large series, but all nodes in the cluster must be
+    running a version of PYME which understands range adverts."
+
     rulenodeserver-nonlocal, default = True, "Whether to bid for non-local tasks if no local tasks are found. Disabling
     non-local bidding (setting this to False) will make task distribution less robust, but is potentially a viable
     workarond if trying to e.g. run recipes which use stupid ammounts of memory and will crash when run non-locally.
@@ -224,6 +232,19 @@ This is a non-exhaustive list of configuration keys - if adding a new key, pleas
     to. Increasing the chunksize can increase data-locality for faster analysis,
     but has spooling/writing bandwidth implications."
 
+    TextFileSource-use_pandas, default=True, "Parse delimited text (e.g. .csv) localization files using pandas.read_csv. Set
+    to False to use the (much slower) legacy np.genfromtxt parser."
+
+    TextFileSource-use_pyarrow, default=True, "Parse delimited text files using the multi-threaded pyarrow CSV reader if
+    pyarrow is installed, falling back to pandas (or np.genfromtxt) for files pyarrow cannot handle."
+
+    TextFileSource-chunk_rows, default=500000, "Number of rows to parse at a time when reading delimited text files with
+    pandas. Bounds peak memory usage when loading very large files."
+
+    TextFileSource-cache_parquet, default=False, "Cache parsed delimited text files as a ``.cache.parquet`` file next to the
+    original (requires pyarrow). The cache is re-used on subsequent loads unless the text file is newer or different
+    parsing options are used."
+
     pymevis-zoom-factor, default = 1.1, adjusts zoom sensitivity by adjusting magnification factor per scroll event
 
 
@@ -30,7 +30,6 @@
 
 
 from PYME.Analysis._fithelpers import *
-from PYME.localization.FitFactories.fitCommon import pack_results
 import logging
 logger = logging.getLogger(__name__)
 
@@ -71,7 +70,11 @@ def astigmatic_gaussian(p, X, Y):
     and b.
     """
     x0, y0, A, b, sx, sy = p
-    return A * np.exp(-(X[:,None]-x0)**2/(2*sx**2) - (Y[None,:] - y0)**2/(2*sy**2)) + b
+    # the gaussian is separable, so evaluate the exponentials along each axis and take the outer product, rather than
+    # evaluating exp() (and several temporaries) over the whole ROI
+    gx = np.exp(-(X - x0)**2/(2*sx**2))
+    gy = np.exp(-(Y - y0)**2/(2*sy**2))
+    return A * np.outer(gx, gy) + b
 
 fresultdtype=[('tIndex', '<i4'),
               ('fitResults', [('y0', '<f4'), ('x0', '<f4'), #Fang and Davids xys are swapped
@@ -87,7 +90,61 @@ fresultdtype=[('tIndex', '<i4'),
               ('LLH', '<f4'),
               ('nFit', '<i4')]
 
+# names of the fit parameters, in the order warpdrive returns them
+_param_names = [n for n, _ in fresultdtype[1][1]]
+# columns of the position and sigma parameters (which need converting from pixels to nm)
+_xy_cols = [0, 1, 4, 5]
+
 _warpdrive = None
+# the (darkmap, varmap, flatmap) arrays last passed to _warpdrive.prepare_maps(). The camera maps are cached (by
+# remFitBuf.CameraInfoManager, or `_uniform_map()` below), so as long as we get the same objects back the maps on the
+# GPU are still good, and we can skip comparing the map contents.
+_prepared_maps = None
+
+# (n_max_candidates_per_frame, 6) views of the warpdrive result buffers, keyed by buffer name. Each entry is a
+# (buffer, view) tuple so that we notice if warpdrive re-allocates the buffer.
+_result_views = {}
+
+def _result_view(name):
+    buffer = getattr(_warpdrive, name)
+    try:
+        buf, view = _result_views[name]
+        if buf is buffer:
+            return view
+    except KeyError:
+        pass
+    
+    view = np.reshape(buffer, (_warpdrive.n_max_candidates_per_frame, 6))
+    _result_views[name] = (buffer, view)
+    return view
+
+# uniform camera maps (for cameras without per-pixel maps), keyed by (value, shape, dtype). These are the same for
+# every frame of a series, so we build them once rather than allocating fresh frame-sized arrays for each frame.
+_uniform_maps = {}
+
+def _uniform_map(value, data):
+    key = (value, np.shape(data), data.dtype.str)
+    try:
+        return _uniform_maps[key]
+    except KeyError:
+        if len(_uniform_maps) > 16:
+            # don't accumulate maps indefinitely if we see lots of different ROIs
+            _uniform_maps.clear()
+        
+        _uniform_maps[key] = value * np.ones_like(data)
+        return _uniform_maps[key]
+
+# per-frame scratch buffers, keyed by name. Fits within a process run one frame at a time and warpdrive copies its
+# inputs to the GPU, so a buffer can be recycled for the next frame.
+_scratch_buffers = {}
+
+def _scratch_buffer(name, shape, dtype=np.float32):
+    buf = _scratch_buffers.get(name, None)
+    if (buf is None) or (buf.shape != shape) or (buf.dtype != dtype):
+        buf = np.empty(shape, dtype)
+        _scratch_buffers[name] = buf
+    
+    return buf
 
 missing_warpdrive_msg = """
 Could not import the warpdrive module. GPU fitting requires the warpdrive module,
@@ -121,7 +178,8 @@ class GaussianFitFactory:
         if isinstance(background, np.ndarray):
             self.background = background.squeeze()  # will be set to contiguous float32 inside of detector class method
         elif np.isscalar(background):
-            self.background = np.ascontiguousarray(background * np.ones_like(self.data), dtype=np.float32)
+            # allocate as float32 directly, rather than allocating, multiplying, and then casting
+            self.background = np.full(np.shape(self.data), background, dtype=np.float32)
         else:  # it's a buffer!
             self.background = background
 
@@ -134,29 +192,35 @@ class GaussianFitFactory:
 
             raise ImportError(missing_warpdrive_msg)
 
-        global _warpdrive  # One instance for each process, re-used for subsequent fits.
+        global _warpdrive, _prepared_maps  # One instance for each process, re-used for subsequent fits.
 
         # get darkmap [ADU]
         self.darkmap = cameraMaps.getDarkMap(self.metadata)
         if np.isscalar(self.darkmap):
-            self.darkmap = self.darkmap * np.ones_like(self.data)
+            self.darkmap = _uniform_map(self.darkmap, self.data)
 
         # get flatmap [unitless]
         self.flatmap = cameraMaps.getFlatfieldMap(self.metadata)
-        if np.isscalar(self.flatmap):
-            self.flatmap = self.flatmap * np.ones_like(self.data)
+        flat_scalar = self.flatmap if np.isscalar(self.flatmap) else None
+        if flat_scalar is not None:
+            self.flatmap = _uniform_map(flat_scalar, self.data)
 
         # get varmap [e-^2]
         self.varmap = cameraMaps.getVarianceMap(self.metadata)
         if np.isscalar(self.varmap):
             if self.varmap == 0:
-                self.varmap = np.ones_like(self.data)
+                self.varmap = 1
                 logger.error('Variance map not found and read noise defaulted to 0; changing to 1 to avoid x/0.')
-            self.varmap = self.varmap*np.ones_like(self.data)
+            self.varmap = _uniform_map(self.varmap, self.data)
 
         if isinstance(self.background, np.ndarray):  # flatfielding is done on CPU-calculated backgrounds
             # fixme - do we change this control flow in remfitbuf by doing our own sigma calc?
-            self.background = self.background/self.flatmap  # no unit conversion here, still in [ADU]
+            if flat_scalar != 1:  # skip the divide if there is no flatfield
+                # no unit conversion here, still in [ADU]. Divide into a recycled float32 buffer (warpdrive would
+                # convert to float32 anyway) rather than allocating a new frame-sized array.
+                self.background = np.divide(self.background, self.flatmap,
+                                            out=_scratch_buffer('background', np.shape(self.background)),
+                                            casting='unsafe')
         else:
             # if self.background is a buffer, the background is already on the GPU and has not been flatfielded
             pass
@@ -172,6 +236,7 @@ class GaussianFitFactory:
             _warpdrive.allocate_memory(np.shape(self.data))
             _warpdrive.prepare_maps(self.darkmap, self.varmap, self.flatmap, self.metadata['Camera.ElectronsPerCount'],
                                     self.metadata['Camera.NoiseFactor'], self.metadata['Camera.TrueEMGain'])
+            _prepared_maps = (self.darkmap, self.varmap, self.flatmap)
             return
 
         need_maps_filtered, need_mem_allocated = False, False
@@ -182,7 +247,10 @@ class GaussianFitFactory:
             need_maps_filtered = True
 
         # check if the data is coming from a different camera region
-        if _warpdrive.varmap.shape != self.varmap.shape:
+        if (_prepared_maps is not None) and all(a is b for a, b in zip(_prepared_maps, (self.darkmap, self.varmap, self.flatmap))):
+            # same map objects as last time (the common case) - nothing to do
+            pass
+        elif _warpdrive.varmap.shape != self.varmap.shape:
             need_mem_allocated, need_maps_filtered = True, True
         else:
             # check if both corners are the same
@@ -197,45 +265,54 @@ class GaussianFitFactory:
             _warpdrive.prepare_maps(self.darkmap, self.varmap, self.flatmap,
                                     self.metadata['Camera.ElectronsPerCount'], self.metadata['Camera.NoiseFactor'],
                                     self.metadata['Camera.TrueEMGain'])
+        
+        _prepared_maps = (self.darkmap, self.varmap, self.flatmap)
 
     def get_results(self):
         # LLH: (N); dpars and CRLB (N, 6)
         #convert pixels to nm; voxelsize in units of um
         voxelsize=self.metadata.voxelsize_nm
         
-        dpars = np.reshape(_warpdrive.fit_res, (_warpdrive.n_max_candidates_per_frame, 6))[:_warpdrive.n_candidates, :]
-        dpars[:, 0] *= (voxelsize.y)
-        dpars[:, 1] *= (voxelsize.x)
-        dpars[:, 4] *= (voxelsize.y)
-        dpars[:, 5] *= (voxelsize.x)
+        # y0, x0, A, background, sigmay, sigmax
+        scale = np.array([voxelsize.y, voxelsize.x, 1, 1, voxelsize.y, voxelsize.x], dtype=np.float32)
+        
+        dpars = _result_view('fit_res')[:_warpdrive.n_candidates]
+        dpars *= scale
 
         LLH = None
         if _warpdrive.calculate_crb:
             LLH = _warpdrive.LLH[:_warpdrive.n_candidates]
-            CRLB = np.reshape(_warpdrive.CRLB, (_warpdrive.n_max_candidates_per_frame, 6))[:_warpdrive.n_candidates, :]
+            CRLB = _result_view('CRLB')[:_warpdrive.n_candidates]
             # fixme: Should never have negative CRLB, yet Yu reports ocassional instances in Matlab verison, check
-            CRLB[:, 0] = np.sqrt(np.abs(CRLB[:, 0]))*(voxelsize.y)
-            CRLB[:, 1] = np.sqrt(np.abs(CRLB[:, 1]))*(voxelsize.x)
-            CRLB[:, 4] = np.sqrt(np.abs(CRLB[:, 4]))*(voxelsize.y)
-            CRLB[:, 5] = np.sqrt(np.abs(CRLB[:, 5]))*(voxelsize.x)
-
-        #return self.chan1.dpars # each fit produces column vector of results, append them all horizontally for return
+            # convert the position and sigma variances to standard deviations in nm (in place, after a single gather)
+            crlb_xy = np.abs(CRLB[:, _xy_cols])
+            np.sqrt(crlb_xy, out=crlb_xy)
+            crlb_xy *= scale[_xy_cols]
+            CRLB[:, _xy_cols] = crlb_xy
+
+        # package our results with the right labels. Fill the output array a column at a time, rather than packing
+        # each candidate individually
         res_list = np.empty(_warpdrive.n_candidates, FitResultsDType)
-        resultCode = 0
         
-        tIndex = int(self.metadata.getOrDefault('tIndex', 0))
-
-        # package our results with the right labels
+        res_list['tIndex'] = int(self.metadata.getOrDefault('tIndex', 0))
+        res_list['resultCode'] = 0
+        res_list['nFit'] = _warpdrive.n_candidates
+        
+        fit_results, fit_error = res_list['fitResults'], res_list['fitError']
+        for i, name in enumerate(_param_names):
+            fit_results[name] = dpars[:, i]
+        
         if _warpdrive.calculate_crb:
-            for ii in range(_warpdrive.n_candidates):
-                res_list[ii] = pack_results(fresultdtype, tIndex=tIndex, fitResults=dpars[ii, :], fitError=CRLB[ii, :],
-                                           LLH=LLH[ii], resultCode=resultCode, nFit=_warpdrive.n_candidates)
+            for i, name in enumerate(_param_names):
+                fit_error[name] = CRLB[:, i]
+            res_list['LLH'] = LLH
         else:
-            for ii in range(_warpdrive.n_candidates):
-                res_list[ii] = pack_results(fresultdtype, tIndex=tIndex, fitResults=dpars[ii, :], fitError=None,
-                                           LLH=LLH[ii], resultCode=resultCode, nFit=_warpdrive.n_candidates)
+            # flag errors as unavailable (as `pack_results()` does)
+            for name in _param_names:
+                fit_error[name] = -5e3
+            res_list['LLH'] = 0
 
-        return np.hstack(res_list)
+        return res_list
 
     def FindAndFit(self, threshold, cameraMaps, **kwargs):
         """
@@ -0,0 +1,169 @@
+import os
+import pytest
+import numpy as np
+
+from PYME import resources
+
+
+def _test_csv_filename():
+    return os.path.join(resources.get_test_data_dir(), 'test_csv.csv')
+
+
+def test_guess_text_options():
+    from PYME.IO import csv_flavours
+    
+    text_options = csv_flavours.guess_text_options(_test_csv_filename())
+    
+    assert text_options['delimiter'] == ','
+    assert text_options['skiprows'] == 1
+    assert text_options['columnnames'][:3] == ['A', 'fitResults_z0', 'fitResults_x0']
+    assert len(text_options['columnnames']) == 24
+
+
+def test_textfile_source():
+    from PYME.IO import csv_flavours, tabular
+    
+    text_options = csv_flavours.guess_text_options(_test_csv_filename())
+    ds = tabular.TextfileSource(_test_csv_filename(), **text_options)
+    
+    # did we load the correct number of localisations?
+    assert len(ds['x']) == 4281
+    assert ds['x'].dtype == np.float32
+    assert np.allclose(ds['x'][:2], [-196.2657, -212.5784])
+
+
+def test_textfile_source_parquet_cache(tmp_path, monkeypatch):
+    import shutil
+    pytest.importorskip('pyarrow')
+    from PYME import config
+    from PYME.IO import csv_flavours, tabular
+    
+    monkeypatch.setitem(config.config, 'TextFileSource-cache_parquet', True)
+    filename = str(tmp_path / 'test_csv.csv')
+    shutil.copy(_test_csv_filename(), filename)
+    
+    text_options = csv_flavours.guess_text_options(filename)
+    ds = tabular.TextfileSource(filename, **text_options)
+    assert os.path.exists(filename + '.cache.parquet')
+    
+    ds_cached = tabular.TextfileSource(filename, **text_options)
+    assert np.all(ds_cached['x'] == ds['x'])
+
+
+
+def test_textfile_source_corrupt_parquet_cache(tmp_path, monkeypatch):
+    import shutil
+    pytest.importorskip('pyarrow')
+    from PYME import config
+    from PYME.IO import csv_flavours, tabular
+    
+    monkeypatch.setitem(config.config, 'TextFileSource-cache_parquet', True)
+    filename = str(tmp_path / 'test_csv.csv')
+    shutil.copy(_test_csv_filename(), filename)
+    
+    # a truncated cache (newer than the text file) should be ignored and rewritten
+    with open(filename + '.cache.parquet', 'wb') as f:
+        f.write(b'PAR1xxx')
+    
+    text_options = csv_flavours.guess_text_options(filename)
+    ds = tabular.TextfileSource(filename, **text_options)
+    assert len(ds['x']) == 4281
+    assert os.path.getsize(filename + '.cache.parquet') > 7
+    
+    ds_cached = tabular.TextfileSource(filename, **text_options)
+    assert np.all(ds_cached['x'] == ds['x'])
+
+def test_textfile_source_missing_values(tmp_path):
+    from PYME.IO import tabular
+    
+    filename = str(tmp_path / 'missing.csv')
+    with open(filename, 'w') as f:
+        f.write('x,y,t\n1,2,3\n4,,6\n7,8,9\n')
+    
+    ds = tabular.TextfileSource(filename, ['x', 'y', 't'], delimiter=',', skiprows=1)
+    
+    # the row with a missing value in the middle column should be discarded
+    assert np.all(ds['x'] == [1, 7])
+    assert np.all(ds['t'] == [3, 9])
+
+
+def test_textfile_source_usecols():
+    from PYME.IO import csv_flavours, tabular
+    
+    text_options = csv_flavours.guess_text_options(_test_csv_filename(), usecols={'t', 'A'})
+    ds = tabular.TextfileSource(_test_csv_filename(), **text_options)
+    
+    # required columns (x, y) are always loaded
+    assert set(ds.keys()) == {'A', 'x', 'y', 't'}
+    assert len(ds['x']) == 4281
+
+
+def test_parse_csv_header_thunderstorm(tmp_path):
+    from PYME.IO import csv_flavours
+    
+    filename = str(tmp_path / 'thunderstorm.csv')
+    with open(filename, 'wb') as f:
+        # thunderstorm files have quoted column names, and sometimes come with a byte order mark
+        f.write(b'\xef\xbb\xbf"id","frame","x [nm]","y [nm]","intensity [photon]"\n')
+        for i in range(20):
+            f.write(b'%d,%d,%f,%f,100.0\n' % (i + 1, i, 1.5*i, 2.5*i))
+    
+    colNames, dataLines, n_header, delim = csv_flavours.parse_csv_header(filename)
+    
+    assert colNames == ['id', 'frame', 'x [nm]', 'y [nm]', 'intensity [photon]']
+    assert n_header == 1
+    assert delim == ','
+    assert len(dataLines) == 10
+    
+    assert csv_flavours.guess_flavour(colNames, delim) == 'thunderstorm'
+    assert csv_flavours.replace_names(colNames, 'thunderstorm') == ['id', 't', 'x', 'y', 'nPhotons']
+
+
+def test_textfile_source_data_offset(tmp_path):
+    from PYME.IO import csv_flavours, tabular
+    
+    filename = str(tmp_path / 'header.csv')
+    with open(filename, 'wb') as f:
+        f.write(b'\xef\xbb\xbf# a comment\nx,y,t\n')
+        for i in range(20):
+            f.write(b'%d,%d,%d\r\n' % (i, 2*i, 3*i))
+    
+    text_options = csv_flavours.guess_text_options(filename)
+    with open(filename, 'rb') as f:
+        f.seek(text_options['data_offset'])
+        assert f.readline() == b'0,0,0\r\n'
+    
+    ds = tabular.TextfileSource(filename, **text_options)
+    assert np.all(ds['y'] == 2*np.arange(20))
+
+
+def test_textfile_source_ignore_errors_fallback(tmp_path, caplog):
+    import logging
+    from PYME.IO import tabular
+    
+    filename = str(tmp_path / 'elyra.txt')
+    with open(filename, 'w') as f:
+        f.write('x\ty\tt\n1\t2\t3\n4\t5\t6\nempty\tline\there\n')
+    
+    # pandas can't parse the trailing text, but falling back to np.genfromtxt is expected rather than an error
+    with caplog.at_level(logging.INFO):
+        ds = tabular.TextfileSource(filename, ['x', 'y', 't'], delimiter='\t', skiprows=1, invalid_raise=False)
+    
+    assert np.all(ds['x'] == [1, 4])
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_data_offset_unusual_line_breaks(tmp_path):
+    from PYME.IO import csv_flavours
+    
+    filename = str(tmp_path / 'header.csv')
+    with open(filename, 'wb') as f:
+        # '\x85' (latin-1) and '\x0c' are line breaks according to str.splitlines(), but not to the parsers
+        f.write(b'# comment\x85with\x0cbreaks\nx,y,t\n')
+        for i in range(20):
+            f.write(b'%d,%d,%d\n' % (i, 2*i, 3*i))
+    
+    text_options = csv_flavours.guess_text_options(filename)
+    with open(filename, 'rb') as f:
+        f.seek(text_options['data_offset'])
+        assert f.readline() == b'0,0,0\n'
@@ -0,0 +1,448 @@
+import time
+import numpy as np
+
+from PYME.cluster import ruleserver
+from PYME.cluster.ruleserver import IntegerIDRule, STATUS_COMPLETE, STATUS_FAILED
+
+TEMPLATE = '{"id": "{{ruleID}}~{{taskID}}", "type": "localization"}'
+
+
+def _bid(rule, task_ids):
+    return rule.bid({'ruleID': rule.ruleID, 'taskIDs': list(task_ids), 'costs': [0.1]*len(task_ids)})
+
+
+def test_release_and_bid():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=1000)
+    rule.make_range_available(0, 100)
+    assert rule.nTotal == 100
+    assert rule.nAvailable == 100
+    
+    # releasing an overlapping range should only count the new tasks
+    rule.make_range_available(50, 150)
+    assert rule.nTotal == 150
+    assert rule.nAvailable == 150
+    
+    res = _bid(rule, range(10, 20))
+    assert list(res['taskIDs']) == list(range(10, 20))
+    assert rule.nAvailable == 140
+    assert rule.nAssigned == 10
+    
+    # tasks which have already been assigned can't be won again
+    res = _bid(rule, range(15, 25))
+    assert list(res['taskIDs']) == list(range(20, 25))
+    assert rule.nAssigned == 15
+    assert np.isclose(rule.avCost, 0.1)
+    
+    # re-releasing assigned tasks should not make them available again
+    rule.make_range_available(0, 150)
+    assert rule.nTotal == 150
+    assert rule.nAvailable == 135
+    
+    advert = rule.advert
+    assert len(advert['availableTaskIDs']) == 135
+    assert 10 not in advert['availableTaskIDs']
+
+
+def test_mark_complete():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=20)
+    rule.make_range_available(0, 20)
+    _bid(rule, range(20))
+    
+    rule.mark_complete({'ruleID': rule.ruleID, 'taskIDs': list(range(15)), 'status': [STATUS_COMPLETE]*15})
+    rule.mark_complete({'ruleID': rule.ruleID, 'taskIDs': list(range(15, 20)), 'status': [STATUS_FAILED]*5})
+    
+    assert rule.nCompleted == 15
+    assert rule.nFailed == 5
+    assert rule.nAssigned == 0
+    assert rule.nAvailable == 0
+    assert rule.finished
+    
+    # repeated handins are counted separately
+    rule.mark_complete({'ruleID': rule.ruleID, 'taskIDs': [0], 'status': [STATUS_COMPLETE]})
+    assert rule.nCompleted == 15
+    assert rule.n_repeats == 1
+
+
+def test_mark_complete_duplicate_ids():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=4)
+    rule.make_range_available(0, 4)
+    _bid(rule, range(4))
+
+    # merged handins can contain the same task twice - this should match applying them one after the other
+    rule.mark_complete({'ruleID': rule.ruleID, 'taskIDs': [0, 1, 0], 'status': [STATUS_COMPLETE]*3})
+
+    assert rule.nCompleted == 2
+    assert rule.nAssigned == 2
+    assert rule.n_repeats == 1
+    assert not rule.finished
+
+    rule.mark_complete({'ruleID': rule.ruleID, 'taskIDs': [2, 2], 'status': [STATUS_COMPLETE, STATUS_FAILED]})
+    assert rule.nCompleted == 2
+    assert rule.nFailed == 1
+    assert rule.nAssigned == 1
+    assert rule.n_repeats == 2
+
+
+def test_poll_timeouts(monkeypatch):
+    monkeypatch.setitem(ruleserver.config.config, 'ruleserver-retries', 1)
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10, task_timeout=-1000)
+    rule.make_range_available(0, 10)
+    _bid(rule, range(5))
+    
+    # tasks have already expired and should be re-queued
+    rule.poll_timeouts()
+    assert rule.n_timed_out == 5
+    assert rule.nAssigned == 0
+    assert rule.nAvailable == 10
+    
+    # second timeout exceeds the number of retries, tasks should be marked as failed
+    _bid(rule, range(5))
+    rule.poll_timeouts()
+    assert rule.nFailed == 5
+    assert rule.nAvailable == 5
+    assert list(rule.advert['availableTaskIDs']) == list(range(5, 10))
+    
+    rule.mark_release_complete()
+    assert rule.nAvailable == 5
+    assert rule.nAssigned == 0
+
+
+def test_next_task_expiry():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10, task_timeout=-1000)
+    rule.make_range_available(0, 10)
+    assert rule.next_task_expiry == float('inf')
+    
+    _bid(rule, range(5))
+    assert rule.next_task_expiry < time.monotonic()
+    
+    rule.poll_timeouts()
+    assert rule.next_task_expiry == float('inf')
+
+
+def test_advert_json():
+    import json
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=100)
+    assert rule.advert_json is None
+    
+    rule.make_range_available(0, 10)
+    assert json.loads(rule.advert_json) == {'ruleID': 'test', 'taskTemplate': TEMPLATE, 'availableTaskIDs': list(range(10))}
+    
+    # should be invalidated when tasks are assigned
+    _bid(rule, range(5))
+    assert json.loads(rule.advert_json)['availableTaskIDs'] == list(range(5, 10))
+
+
+def test_advertise_ranges(monkeypatch):
+    monkeypatch.setitem(ruleserver.config.config, 'ruleserver-advertise-ranges', True)
+    
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=100)
+    rule.make_range_available(0, 50)
+    _bid(rule, [10, 11, 20])
+    
+    advert = rule.advert
+    assert advert['availableTaskRanges'] == [[0, 10], [12, 20], [21, 50]]
+    assert 'availableTaskIDs' not in advert
+
+
+def test_ruleserver_handin():
+    import json
+    import time
+    
+    rs = ruleserver.RuleServer()
+    try:
+        rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10)
+        rule.make_range_available(0, 10)
+        rs._rules[rule.ruleID] = rule
+        _bid(rule, range(10))
+        
+        resp = rs.handin(json.dumps([{'ruleID': 'test', 'taskIDs': [0, 1], 'status': [STATUS_COMPLETE]*2},
+                                     {'ruleID': 'test', 'taskIDs': [2], 'status': [STATUS_FAILED]}]))
+        assert json.loads(resp)['ok'] == 'True'
+        
+        # handins for rules which don't exist (e.g. have expired) are reported
+        resp = rs.handin(json.dumps([{'ruleID': 'missing', 'taskIDs': [0], 'status': [STATUS_COMPLETE]}]))
+        assert json.loads(resp)['ok'] == 'False'
+        
+        # handins may be applied asynchronously
+        t = time.time()
+        while (rule.nAssigned > 7) and (time.time() - t) < 5:
+            time.sleep(0.01)
+        
+        assert rule.nCompleted == 2
+        assert rule.nFailed == 1
+        assert rule.nAssigned == 7
+    finally:
+        rs.stop()
+
+
+def test_apply_handins_error_in_one_rule():
+    rs = ruleserver.RuleServer()
+    try:
+        rules = []
+        for ruleID in ['bad', 'good']:
+            rule = IntegerIDRule(ruleID, TEMPLATE, max_task_ID=10)
+            rule.make_range_available(0, 10)
+            _bid(rule, range(10))
+            rs._rules[ruleID] = rule
+            rules.append(rule)
+        
+        # an out of range task ID is rejected for the first rule
+        rs._apply_handins([{'ruleID': 'bad', 'taskIDs': [100], 'status': [STATUS_COMPLETE]},
+                           {'ruleID': 'good', 'taskIDs': [0, 1], 'status': [STATUS_COMPLETE]*2}])
+        
+        assert rules[1].nCompleted == 2
+        assert rules[1].nAssigned == 8
+        
+        # invalid handins for a rule should not lose valid handins for the same rule in the same batch
+        rs._apply_handins([{'ruleID': 'good', 'taskIDs': [100], 'status': [STATUS_COMPLETE]},
+                           {'ruleID': 'good', 'taskIDs': [2, 3], 'status': [STATUS_COMPLETE]},
+                           {'ruleID': 'good', 'taskIDs': [4], 'status': [STATUS_COMPLETE]}])
+        
+        assert rules[1].nCompleted == 3
+        assert rules[1].nAssigned == 7
+    finally:
+        rs.stop()
+
+
+def test_handins_applied_on_stop():
+    rs = ruleserver.RuleServer()
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10)
+    rule.make_range_available(0, 10)
+    rs._rules[rule.ruleID] = rule
+    _bid(rule, range(10))
+    
+    rs._handin_queue.put([{'ruleID': 'test', 'taskIDs': [0, 1], 'status': [STATUS_COMPLETE]*2}])
+    rs.stop()
+    rs.handinThread.join(5)
+    
+    assert rule.nCompleted == 2
+
+
+def test_update_nums():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=20)
+    rule.make_range_available(0, 10)
+    _bid(rule, range(3))
+    rule.mark_complete({'ruleID': rule.ruleID, 'taskIDs': [0], 'status': [STATUS_COMPLETE]})
+    
+    rule.nAvailable = 0
+    rule.nCompleted = 5
+    rule.mark_release_complete()
+    
+    assert (rule.nTotal, rule.nAvailable, rule.nAssigned, rule.nCompleted, rule.nFailed) == (10, 7, 2, 1, 0)
+
+
+def test_task_advertisements_round_robin(monkeypatch):
+    import json
+    
+    rs = ruleserver.RuleServer()
+    try:
+        monkeypatch.setattr(rs, 'MAX_ADVERTISEMENTS', 10)
+        for i in range(3):
+            rule = IntegerIDRule('rule%d' % i, TEMPLATE, max_task_ID=10)
+            rule.make_range_available(0, 10)
+            rs._rules[rule.ruleID] = rule
+        
+        # each call should start with the rule after the last one advertised
+        for i in range(4):
+            rs._cached_advert_expiry = 0
+            adverts = json.loads(rs.task_advertisements())
+            assert [a['ruleID'] for a in adverts] == ['rule%d' % (i % 3)]
+    finally:
+        rs.stop()
+
+
+def test_task_arrays_grow(monkeypatch):
+    monkeypatch.setattr(IntegerIDRule, 'INITIAL_TASK_CAPACITY', 16)
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=1000)
+    assert len(rule._status) == 16
+    
+    for i in range(0, 100, 10):
+        rule.make_range_available(i, i + 10)
+    
+    assert 100 <= len(rule._status) <= 1000
+    assert rule.nAvailable == 100
+    
+    # bids on tasks which have not been released yet should not fail
+    res = _bid(rule, range(95, 105))
+    assert list(res['taskIDs']) == list(range(95, 100))
+    
+    rule.make_range_available(900, 1000)
+    assert len(rule._status) == 1000
+
+
+def test_advert_not_regenerated_without_changes():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=100)
+    rule.make_range_available(0, 50)
+    advert_json = rule.advert_json
+    
+    # none of these change the available tasks, so should re-use the cached advert
+    rule.make_range_available(0, 50)
+    _bid(rule, [60])
+    rule.poll_timeouts()
+    assert rule.advert_json is advert_json
+
+
+def test_advert_sparse_and_dense():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=1000)
+    rule.make_range_available(0, 1000)
+    
+    # dense - scan the status array
+    _bid(rule, range(0, 1000, 2))
+    assert list(rule.advert['availableTaskIDs']) == list(range(1, 1000, 2))
+    
+    # sparse - use the set of available tasks
+    _bid(rule, range(1, 990, 2))
+    assert list(rule.advert['availableTaskIDs']) == list(range(991, 1000, 2))
+
+
+def test_snapshot():
+    rule = IntegerIDRule('test', TEMPLATE, max_task_ID=100)
+    rule.make_range_available(0, 10)
+    _bid(rule, range(4))
+    rule.mark_complete({'ruleID': 'test', 'taskIDs': [0, 1], 'status': [STATUS_COMPLETE, STATUS_FAILED]})
+    
+    counts = rule.snapshot()
+    assert (counts.nTotal, counts.nAvailable, counts.nAssigned, counts.nCompleted, counts.nFailed) == (10, 6, 2, 1, 1)
+    assert counts.n_max == 100
+    assert rule.info()['tasksRunning'] == 2
+    
+    rule.mark_release_complete()
+    assert rule.snapshot().n_max == 10
+    assert not rule.finished
+
+
+def test_poll_rules_chaining_and_expiry(monkeypatch):
+    monkeypatch.setattr(ruleserver.RuleServer, 'RULE_POLL_INTERVAL', 0.05)
+    rs = ruleserver.RuleServer()
+    try:
+        rs._finished_rule_timeout = -1 # expire finished rules straight away
+        rule = IntegerIDRule('test', TEMPLATE, max_task_ID=2, on_completion={'template': TEMPLATE, 'max_tasks': 3})
+        rule.make_range_available(0, 2)
+        _bid(rule, range(2))
+        rule.mark_complete({'ruleID': 'test', 'taskIDs': [0, 1], 'status': [STATUS_COMPLETE]*2})
+        with rs._rule_lock:
+            rs._rules[rule.ruleID] = rule
+            rs._rules_gen += 1
+        
+        # the finished rule should be replaced by its follow-on rule
+        t = time.time()
+        while ('test' in rs._rules) and (time.time() - t) < 5:
+            time.sleep(0.01)
+        
+        rules = list(rs._rules.values())
+        assert len(rules) == 1
+        assert rules[0].nAvailable == 3
+    finally:
+        rs.stop()
+
+
+
+def test_poll_rules_error_in_one_rule(monkeypatch):
+    monkeypatch.setattr(ruleserver.RuleServer, 'RULE_POLL_INTERVAL', 0.05)
+    rs = ruleserver.RuleServer()
+    try:
+        rs._finished_rule_timeout = -1 # expire finished rules straight away
+        
+        def _raise():
+            raise RuntimeError('error in rule code')
+        
+        bad = IntegerIDRule('bad', TEMPLATE, max_task_ID=2, task_timeout=-1000)
+        bad.make_range_available(0, 2)
+        _bid(bad, range(2))
+        monkeypatch.setattr(bad, 'poll_timeouts', _raise)
+        
+        good = IntegerIDRule('good', TEMPLATE, max_task_ID=2)
+        good.make_range_available(0, 2)
+        _bid(good, range(2))
+        good.mark_complete({'ruleID': 'good', 'taskIDs': [0, 1], 'status': [STATUS_COMPLETE]*2})
+        
+        with rs._rule_lock:
+            rs._rules['bad'] = bad
+            rs._rules['good'] = good
+            rs._rules_gen += 1
+        
+        # errors polling one rule should not stop other rules from being polled
+        t = time.time()
+        while ('good' in rs._rules) and (time.time() - t) < 5:
+            time.sleep(0.01)
+        
+        assert list(rs._rules.keys()) == ['bad']
+    finally:
+        rs.stop()
+
+def test_get_queues():
+    import json
+    
+    rs = ruleserver.RuleServer()
+    try:
+        rs._cached_info_timeout = 0
+        info = json.loads(rs.get_queues())
+        assert info['ok'] and info['result'] == {}
+        
+        rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10)
+        rule.make_range_available(0, 10)
+        with rs._rule_lock:
+            rs._rules[rule.ruleID] = rule
+        rs._rules_changed()
+        
+        info = rs.get_queues()
+        assert json.loads(info)['result']['test']['tasksPosted'] == 10
+        # nothing has changed, so we should get the same response back without re-serialising
+        assert rs.get_queues() is info
+        
+        rs.bid_on_tasks(json.dumps([{'ruleID': 'test', 'taskIDs': list(range(4)), 'costs': [0.1]*4}]))
+        assert json.loads(rs.get_queues())['result']['test']['tasksRunning'] == 4
+    finally:
+        rs.stop()
+
+
+def test_queue_info_longpoll():
+    import json
+    import threading
+    
+    rs = ruleserver.RuleServer()
+    try:
+        rs._cached_info_timeout = 0
+        rs.get_queues()
+        
+        def add_rule():
+            time.sleep(0.2)
+            rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10)
+            with rs._rule_lock:
+                rs._rules[rule.ruleID] = rule
+            rs._rules_changed()
+        
+        threading.Thread(target=add_rule).start()
+        
+        # we should wake up as soon as the rule is added, rather than waiting for the timeout
+        t = time.time()
+        info = json.loads(rs.get_queue_info())
+        assert 0.1 < (time.time() - t) < 0.5*rs.LONGPOLL_TIMEOUT
+        assert 'test' in info['result']
+    finally:
+        rs.stop()
+
+
+def test_queue_info_longpoll_version():
+    import json
+    
+    rs = ruleserver.RuleServer()
+    try:
+        rs._cached_info_timeout = 0
+        seen = json.loads(rs.get_queue_info())
+        
+        # the info changes (and is rebuilt by someone else) between polls
+        rule = IntegerIDRule('test', TEMPLATE, max_task_ID=10)
+        with rs._rule_lock:
+            rs._rules[rule.ruleID] = rule
+        rs._rules_changed()
+        rs.get_queues()
+        
+        # a client which tells us what it last saw should get the new info straight away
+        t = time.time()
+        info = json.loads(rs.get_queue_info(version=str(seen['version'])))
+        assert (time.time() - t) < 0.5*rs.LONGPOLL_TIMEOUT
+        assert 'test' in info['result']
+        assert info['version'] != seen['version']
+    finally:
+        rs.stop()
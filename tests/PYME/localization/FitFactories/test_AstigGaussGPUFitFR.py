@@ -0,0 +1,73 @@
+import types
+import numpy as np
+
+from PYME.IO.MetaDataHandler import NestedClassMDHandler
+from PYME.localization.FitFactories import AstigGaussGPUFitFR
+from PYME.localization.FitFactories.fitCommon import pack_results
+
+
+def test_get_results_matches_pack_results(monkeypatch):
+    # get_results() fills the results array column-wise - check that this gives the same output as packing each
+    # candidate with pack_results()
+    n_max, n = 10, 5
+    fit_res = np.random.rand(6*n_max).astype('f4')
+    crlb = (np.random.rand(6*n_max) - 0.2).astype('f4')
+    llh = np.random.rand(n_max).astype('f4')
+    
+    # stand in for the GPU detector, which just exposes host-side result buffers
+    wd = types.SimpleNamespace(n_candidates=n, n_max_candidates_per_frame=n_max, calculate_crb=True,
+                               fit_res=fit_res.copy(), CRLB=crlb.copy(), LLH=llh)
+    monkeypatch.setattr(AstigGaussGPUFitFR, '_warpdrive', wd)
+    
+    md = NestedClassMDHandler()
+    md['voxelsize.x'] = 0.1
+    md['voxelsize.y'] = 0.12
+    md['tIndex'] = 3
+    
+    ff = AstigGaussGPUFitFR.GaussianFitFactory(np.zeros((20, 20)), md)
+    res = ff.get_results()
+    
+    vs = md.voxelsize_nm
+    dpars = fit_res.reshape(n_max, 6)[:n]
+    dpars[:, [0, 4]] *= vs.y
+    dpars[:, [1, 5]] *= vs.x
+    errs = crlb.reshape(n_max, 6)[:n]
+    errs[:, [0, 4]] = np.sqrt(np.abs(errs[:, [0, 4]]))*vs.y
+    errs[:, [1, 5]] = np.sqrt(np.abs(errs[:, [1, 5]]))*vs.x
+    
+    expected = np.hstack([pack_results(AstigGaussGPUFitFR.fresultdtype, tIndex=3, fitResults=dpars[i], fitError=errs[i],
+                                       LLH=llh[i], resultCode=0, nFit=n) for i in range(n)])
+    
+    assert res.dtype == expected.dtype
+    assert res.tobytes() == expected.tobytes()
+
+
+def test_get_results_without_crb(monkeypatch):
+    # without CRB there are no errors or likelihoods from the GPU - errors are flagged as unavailable (as with
+    # pack_results()) and LLH is 0
+    n_max, n = 10, 5
+    fit_res = np.random.rand(6*n_max).astype('f4')
+    
+    wd = types.SimpleNamespace(n_candidates=n, n_max_candidates_per_frame=n_max, calculate_crb=False,
+                               fit_res=fit_res.copy(), CRLB=None, LLH=None)
+    monkeypatch.setattr(AstigGaussGPUFitFR, '_warpdrive', wd)
+    
+    md = NestedClassMDHandler()
+    md['voxelsize.x'] = 0.1
+    md['voxelsize.y'] = 0.12
+    
+    ff = AstigGaussGPUFitFR.GaussianFitFactory(np.zeros((20, 20)), md)
+    res = ff.get_results()
+    
+    vs = md.voxelsize_nm
+    dpars = fit_res.reshape(n_max, 6)[:n]
+    dpars[:, [0, 4]] *= vs.y
+    dpars[:, [1, 5]] *= vs.x
+    
+    expected = np.hstack([pack_results(AstigGaussGPUFitFR.fresultdtype, tIndex=0, fitResults=dpars[i], LLH=0,
+                                       resultCode=0, nFit=n) for i in range(n)])
+    
+    assert res.tobytes() == expected.tobytes()
+    for name in res['fitError'].dtype.names:
+        assert np.all(res['fitError'][name] == -5e3)
+    assert np.all(res['LLH'] == 0)